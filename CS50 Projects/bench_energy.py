@@ -0,0 +1,107 @@
+""" Time EnergyDB loading and queries against the original row-at-a-time
+approach, on a generated EIA-style production file. """
+
+
+from argparse import ArgumentParser
+import math
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+from energy import EnergyDB
+
+
+STATES = ["AK", "AL", "AR", "AZ", "CA", "CO", "CT", "DE", "FL", "GA", "HI",
+          "IA", "ID", "IL", "IN", "KS", "KY", "LA", "MA", "MD", "ME", "MI",
+          "MN", "MO", "MS", "MT", "NC", "ND", "NE", "NH", "NJ", "NM", "NV",
+          "NY", "OH", "OK", "OR", "PA", "RI", "SC", "SD", "TN", "TX", "UT",
+          "VA", "VT", "WA", "WI", "WV", "WY"]
+SOURCES = ["Coal", "Natural Gas", "Nuclear", "Hydroelectric Conventional",
+           "Petroleum", "Solar Thermal and Photovoltaic", "Wind", "Wood and Wood Derived Fuels"]
+QUERIES = [(source, year) for source in SOURCES for year in (1990, 2005, 2017)]
+
+
+def write_production(filename, rows, seed=0):
+    """ Write a CSV shaped like the EIA production file.
+
+    Args:
+        filename (str): where to write the file.
+        rows (int): number of data rows.
+        seed (int): seed for the random values (default: 0).
+    """
+    rng = random.Random(seed)
+    with open(filename, 'w') as file:
+        file.write("Year,State,Energy Source,Megawatthours\n")
+        for _ in range(rows):
+            file.write(f"{rng.randint(1990, 2017)},{rng.choice(STATES)},"
+                       f"{rng.choice(SOURCES)},{rng.uniform(0, 1e6):.2f}\n")
+
+
+class OriginalEnergyDB:
+    """ The original EnergyDB: one INSERT per line and sums done in Python. """
+
+    def __init__(self, filename):
+        self.conn = sqlite3.connect(':memory:')
+        cursor = self.conn.cursor()
+        cursor.execute("CREATE TABLE production (year integer, state text, source text, mwh real)")
+        with open(filename, 'r') as file:
+            next(file)
+            for line in file:
+                year, state, source, mwh = line.strip().split(',')
+                cursor.execute("INSERT INTO production VALUES (?, ?, ?, ?)",
+                               (int(year), state, source, float(mwh)))
+        self.conn.commit()
+
+    def production_by_source(self, source, year):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT mwh FROM production WHERE source=? AND year=?", (source, year))
+        return sum(row[0] for row in cursor.fetchall())
+
+
+def time_db(label, cls, filename):
+    """ Load filename with cls, run every query once, and report timings.
+
+    Returns:
+        list of float: the query results, for comparison.
+    """
+    start = time.perf_counter()
+    db = cls(filename)
+    load = time.perf_counter() - start
+    start = time.perf_counter()
+    results = [db.production_by_source(source, year) for source, year in QUERIES]
+    query = (time.perf_counter() - start) / len(QUERIES)
+    print(f"{label}: load {load:.2f}s, {query * 1000:.3f} ms per query")
+    return results
+
+
+def main(rows):
+    """ Generate a production file and time both databases on it.
+
+    Side effects:
+        Writes to stdout.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, "production.csv")
+        write_production(filename, rows)
+        print(f"{rows} rows")
+        before = time_db("before", OriginalEnergyDB, filename)
+        after = time_db("after", EnergyDB, filename)
+    # sqlite may add the rows up in a different order, so allow rounding differences
+    if not all(math.isclose(b, a, rel_tol=1e-9) for b, a in zip(before, after)):
+        sys.exit("Error: query results differ")
+
+
+def parse_args(arglist):
+    """ Parse command-line arguments. """
+    parser = ArgumentParser()
+    parser.add_argument("-n", "--rows", type=int, default=2000000,
+                        help="number of rows to generate (default: 2000000)")
+    return parser.parse_args(arglist)
+
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    main(args.rows)
@@ -0,0 +1,67 @@
+"""Measure Monte Carlo scenario throughput of mortgage.simulate_portfolio"""
+
+from argparse import ArgumentParser
+import os
+import random
+import sys
+import time
+from mortgage import get_min_payment, simulate_portfolio
+
+def make_loans(count, seed=0):
+    """Random loans with targets at or above the minimum payment
+
+    Args:
+        count (int): Number of loans
+        seed (int): Seed for the random loans (default: 0)
+
+    Returns:
+        list of dict: Keyword arguments for simulate_loan
+    """
+    rng = random.Random(seed)
+    loans = []
+    for _ in range(count):
+        principal = rng.uniform(50000, 1000000)
+        rate = rng.uniform(0.02, 0.08)
+        term = rng.choice([15, 30])
+        payment = get_min_payment(principal, rate, term) * rng.uniform(1, 1.3)
+        loans.append({"principal": principal, "annual_interest_rate": rate,
+                      "target_payment": payment, "term": term})
+    return loans
+
+def main(loans, paths, processes):
+    """Simulate a portfolio and print scenarios per second, per core
+
+    Args:
+        loans (int): Number of loans
+        paths (int): Paths per loan
+        processes (list of int): Process counts to time
+    """
+    portfolio = make_loans(loans)
+    scenario = {"paths": paths, "extra_chance": 0.05, "extra_mean": 500,
+                "reset_every": 60, "rate_volatility": 0.01, "rate_floor": 0.01, "rate_cap": 0.12}
+    for count in processes:
+        start = time.perf_counter()
+        simulate_portfolio(portfolio, seed=0, processes=count, **scenario)
+        elapsed = time.perf_counter() - start
+        rate = loans * paths / elapsed
+        print(f"{count} process(es): {elapsed:.2f}s, {rate:,.0f} scenarios/s, {rate / count:,.0f} per core")
+
+def parse_args(arglist):
+    """Parse command-line arguments.
+
+    Args:
+        arglist (list of str): List of command-line arguments.
+
+    Returns:
+        namespace: The parsed arguments.
+    """
+    parser = ArgumentParser()
+    parser.add_argument("-l", "--loans", type=int, default=200, help="number of loans (default: 200)")
+    parser.add_argument("-p", "--paths", type=int, default=1000, help="paths per loan (default: 1000)")
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, os.cpu_count() or 1],
+                        help="process counts to time (default: 1 and one per CPU)")
+    return parser.parse_args(arglist)
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    main(args.loans, args.paths, args.processes)
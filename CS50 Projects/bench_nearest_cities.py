@@ -0,0 +1,79 @@
+""" Compare the k-d tree in Cities.nearest with sorting every city by distance,
+and one-at-a-time lookups with the batch Cities.nearest_many. """
+
+from argparse import ArgumentParser
+import os
+import random
+import sys
+import tempfile
+import time
+from haversine import haversine
+from nearest_cities import Cities
+
+def write_cities(filename, count, seed=0):
+    """ Write a file of random cities in the format Cities reads
+
+    Args:
+    filename (str): Where to write the file
+    count (int): How many cities to write
+    seed (int): Seed for the random coordinates (default: 0) """
+
+    rng = random.Random(seed)
+    with open(filename, 'w') as file:
+        for i in range(count):
+            lat = rng.uniform(-90, 90)
+            lon = rng.uniform(-180, 180)
+            file.write(f"Area{i % 50},City{i},{lat:.5f},{lon:.5f}\n")
+
+def nearest_by_sort(cities, point, k=5):
+    """ The original lookup: sort every city by haversine distance """
+    return sorted(cities.cities, key=lambda x: haversine(point, cities.cities[x]))[:k]
+
+def main(count, queries, k):
+    """ Build a random city file, then time both lookups on the same queries
+
+    Side effects:
+    Writes to stdout. """
+
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, "cities.csv")
+        write_cities(filename, count)
+        start = time.perf_counter()
+        cities = Cities(filename)
+        print(f"Loaded {count} cities and built the index in {time.perf_counter() - start:.2f}s")
+
+    rng = random.Random(1)
+    points = [(rng.uniform(-90, 90), rng.uniform(-180, 180)) for _ in range(queries)]
+
+    start = time.perf_counter()
+    tree_results = [cities.nearest(point, k) for point in points]
+    tree_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    sort_results = [nearest_by_sort(cities, point, k) for point in points]
+    sort_time = time.perf_counter() - start
+
+    print(f"k-d tree: {tree_time / queries * 1000:.3f} ms per query")
+    print(f"full sort: {sort_time / queries * 1000:.3f} ms per query")
+    print(f"speedup: {sort_time / tree_time:.1f}x")
+    if tree_results != sort_results:
+        sys.exit("Error: k-d tree and full sort results differ")
+
+    start = time.perf_counter()
+    indexes, _ = cities.nearest_many(points, k)
+    batch_time = time.perf_counter() - start
+    print(f"nearest_many: {batch_time / queries * 1000:.3f} ms per query")
+    if [[cities.names[i] for i in row] for row in indexes] != tree_results:
+        sys.exit("Error: nearest_many and k-d tree results differ")
+
+def parse_args(arglist):
+    """ Parse command-line arguments. """
+    parser = ArgumentParser()
+    parser.add_argument("-n", "--cities", type=int, default=100000, help="number of cities (default: 100000)")
+    parser.add_argument("-q", "--queries", type=int, default=20, help="number of lookups (default: 20)")
+    parser.add_argument("-k", type=int, default=5, help="cities per lookup (default: 5)")
+    return parser.parse_args(arglist)
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    main(args.cities, args.queries, args.k)
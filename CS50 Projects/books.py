@@ -1,8 +1,46 @@
 """ Sort books by Library of Congress call number. """
 
 from argparse import ArgumentParser
+from array import array
+import bisect
+from collections.abc import Sequence
+from concurrent.futures import ProcessPoolExecutor
+import heapq
+import itertools
+import mmap
+from operator import attrgetter
+import os
 import re
+import struct
 import sys
+import tempfile
+
+CALL_NUMBER_PATTERN = re.compile(r'([A-Z]{1,3})(\d{1,4}(?:\.\d+)?)(?:\s*\.([A-Z]\d+))?(?:\s([A-Z]\d+))?\s*(\d{4})')
+# The leading parts of a call number, for lookups like "QA76" or "QA76.73 .P98"
+PARTIAL_CALL_NUMBER_PATTERN = re.compile(r'([A-Z]{1,3})(?:(\d{1,4}(?:\.\d+)?)(?:\s*\.([A-Z]\d+)(?:\s([A-Z]\d+))?)?(?:\s*(\d{4}))?)?')
+# Values that sort after anything in each position of a call number key
+KEY_MAXIMUMS = ('\U0010ffff', float('inf'), '\U0010ffff', '\U0010ffff', float('inf'))
+
+# Books sorted in memory at a time by sort_catalog
+RUN_SIZE = 1000000
+# Bytes of the catalog each worker of ingest_catalog parses at a time
+CHUNK_BYTES = 64 * 1024 * 1024
+
+# Saved shelf indexes: magic, the catalog's size and mtime, the number of
+# books and where the line offsets start; then the books as catalog lines
+# in shelf order, and an offset per line plus the end of the last
+INDEX_MAGIC = b"SHELFIX2"
+INDEX_HEADER = struct.Struct("<8sqqqq")
+
+def call_number_key(callnum):
+    """ Parses the call number into a tuple that sorts in shelf order
+
+    Returns an empty tuple, which sorts first, if the call number can't be parsed """
+    match = CALL_NUMBER_PATTERN.match(callnum)
+    if match:
+        groups = match.groups()
+        return (groups[0], float(groups[1]), groups[2] if groups[2] else '', groups[3] if groups[3] else '', int(groups[4]))
+    return ()
 
 class Book:
     """ A class for books with a call number from the Library of Congress
@@ -11,12 +49,16 @@ class Book:
         callnum (str): Call number of the book
         title (str): Title of the book
         author (str): Author of the book
+        key (tuple): The parsed call number, worked out once so sorting doesn't re-parse it
     """
+    __slots__ = ("callnum", "title", "author", "key")
+
     def __init__(self, callnum, title, author):
         """ Set up the call number, title, and author of the book """
         self.callnum = callnum
         self.title = title
         self.author = author
+        self.key = call_number_key(callnum)
     
     def __repr__(self):
         """ Returns a string of all the information """
@@ -24,41 +66,334 @@ class Book:
     
     def __lt__(self, other):
         """ Orders books by their call number """
-        return self.parse_call_number(self.callnum) < self.parse_call_number(other.callnum)
+        return self.key < other.key
     
     def parse_call_number(self, callnum):
         """ Parses the call number to be sorted """
-        match = re.match(r'([A-Z]{1,3})(\d{1,4}(?:\.\d+)?)(?:\s*\.([A-Z]\d+))?(?:\s([A-Z]\d+))?\s*(\d{4})', callnum)
-        if match:
-            groups = match.groups()
-            return (groups[0], float(groups[1]), groups[2] if groups[2] else '', groups[3] if groups[3] else '', int(groups[4]))
-        return ()
-
-def read_books(filename):
-    """ Takes book information from the file and finds inidividual book lists and information """
+        return call_number_key(callnum)
+
+def partial_key(callnum):
+    """ Parses the leading parts of a call number into the start of a key
+
+    Raises:
+        ValueError: The call number doesn't start with class letters """
+    match = PARTIAL_CALL_NUMBER_PATTERN.fullmatch(callnum.strip())
+    if not match:
+        raise ValueError(f"can't parse call number {callnum!r}")
+    key = []
+    for i, group in enumerate(match.groups()):
+        if group is None:
+            # missing cutters in a full call number are blank
+            if i in (2, 3) and match.group(5) is not None:
+                key.append('')
+                continue
+            break
+        key.append(float(group) if i == 1 else int(group) if i == 4 else group)
+    return tuple(key)
+
+class ShelfRows(Sequence):
+    """ The books of a saved shelf index, parsed only when they are looked at
+
+    Each book is a catalog line in a memory-mapped file, with an offset
+    per line, so loading an index doesn't create any Book objects. """
+
+    def __init__(self, buffer, offsets):
+        """ Set up the rows from the mapped file and the start of each line, plus the end of the last """
+        self.buffer = buffer
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def fields(self, i):
+        """ Returns the title, author and call number on line i """
+        return bytes(self.buffer[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8').rstrip('\n').split('\t')
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("book index out of range")
+        title, author, callnum = self.fields(i)
+        return Book(callnum, title, author)
+
+class ShelfKeys(Sequence):
+    """ The call number keys of ShelfRows, parsed one at a time as bisect asks for them """
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        return call_number_key(self.rows.fields(i)[2])
+
+class ShelfIndex:
+    """ Books in shelf order, for looking up call number ranges without re-sorting
+
+    Attributes:
+        books (sequence of Book): The books, sorted by call number
+        keys (sequence of tuple): The key of each book, in the same order
+        source (tuple): Size and modification time of the catalog the index was built from
+    """
+
+    def __init__(self, books, presorted=False, source=None, keys=None):
+        """ Builds the index from books, sorting them unless presorted is true """
+        if not presorted:
+            books = sorted(books, key=attrgetter("key"))
+        self.books = books if isinstance(books, Sequence) else list(books)
+        self.keys = keys if keys is not None else [book.key for book in self.books]
+        self.source = source
+
+    def between(self, low, high):
+        """ Returns the books from call number low through high, ex. "QA76" to "QA77.9"
+
+        Both ends may be partial call numbers; everything that starts with high is included. """
+        low_key = partial_key(low)
+        high_key = partial_key(high)
+        high_key += KEY_MAXIMUMS[len(high_key):len(high_key) + 1]
+        return self.books[bisect.bisect_left(self.keys, low_key):bisect.bisect_right(self.keys, high_key)]
+
+    def after(self, callnum, count=20):
+        """ Returns the next count books on the shelf after callnum
+
+        For a partial call number, this starts at the first book under it. """
+        start = bisect.bisect_right(self.keys, partial_key(callnum))
+        return self.books[start:start + count]
+
+    def with_class(self, letters):
+        """ Returns the books whose class letters start with letters, ex. "Q" or "QA" """
+        start = bisect.bisect_left(self.keys, (letters,))
+        end = bisect.bisect_left(self.keys, (letters + KEY_MAXIMUMS[0],))
+        return self.books[start:end]
+
+    def save(self, filename):
+        """ Writes the index to a file: the books as catalog lines, then an array of line offsets """
+        size, mtime_ns = self.source or (-1, -1)
+        offsets = array('q', [INDEX_HEADER.size])
+        temp_file = f"{filename}.{os.getpid()}.tmp"
+        with open(temp_file, 'wb') as file:
+            file.write(bytes(INDEX_HEADER.size))
+            for book in self.books:
+                line = f"{book.title}\t{book.author}\t{book.callnum}\n".encode('utf-8')
+                file.write(line)
+                offsets.append(offsets[-1] + len(line))
+            file.write(bytes(-offsets[-1] % 8))
+            file.write(offsets)
+            file.seek(0)
+            file.write(INDEX_HEADER.pack(INDEX_MAGIC, size, mtime_ns, len(self.books), offsets[-1] + -offsets[-1] % 8))
+        os.replace(temp_file, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """ Reads an index written by save, mapping it into memory instead of reading every book
+
+        Raises:
+            ValueError: The file isn't a shelf index written by save """
+        with open(filename, 'rb') as file:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(buffer) < INDEX_HEADER.size or buffer[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+            raise ValueError(f"{filename} is not a shelf index from this version")
+        magic, size, mtime_ns, count, offsets_start = INDEX_HEADER.unpack_from(buffer)
+        if count < 0 or offsets_start < INDEX_HEADER.size or offsets_start + 8 * (count + 1) != len(buffer):
+            raise ValueError(f"{filename} is a damaged shelf index")
+        offsets = memoryview(buffer)[offsets_start:].cast('q')
+        rows = ShelfRows(buffer, offsets)
+        source = None if size < 0 else (size, mtime_ns)
+        return cls(rows, presorted=True, source=source, keys=ShelfKeys(rows))
+
+    @classmethod
+    def for_catalog(cls, filename, index_file):
+        """ Loads the index for a catalog, building and saving it first if it's missing or out of date """
+        stat = os.stat(filename)
+        source = (stat.st_size, stat.st_mtime_ns)
+        try:
+            index = cls.load(index_file)
+            if index.source == source:
+                return index
+        except (OSError, ValueError):
+            pass
+        index = cls(read_books(filename), source=source)
+        index.save(index_file)
+        return index
+
+def parse_line(line):
+    """ Makes a Book from a catalog line of title, author and call number separated by tabs
+
+    Raises:
+        ValueError: The line doesn't have exactly three fields """
+    fields = line.strip().split('\t')
+    if len(fields) != 3:
+        raise ValueError(f"expected 3 tab-separated fields, found {len(fields)}")
+    title, author, callnum = fields
+    return Book(callnum, title, author)
+
+def read_books(filename, rejects=None):
+    """ Takes book information from the file and finds inidividual book lists and information
+
+    If rejects is a list, malformed lines are added to it as (line number, reason, line) instead of raising ValueError """
     books = []
     with open(filename, 'r', encoding='utf-8') as file:
-        for line in file:
-            title, author, callnum = line.strip().split('\t')
-            books.append(Book(callnum, title, author))
+        for number, line in enumerate(file, 1):
+            try:
+                books.append(parse_line(line))
+            except ValueError as e:
+                if rejects is None:
+                    raise
+                rejects.append((number, str(e), line.rstrip('\n')))
     return books
 
+def write_run(books, directory):
+    """ Writes books to a temporary file in the same tab-separated format as the catalog, and returns its name """
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=directory, suffix='.tsv', delete=False) as run:
+        for book in books:
+            run.write(f"{book.title}\t{book.author}\t{book.callnum}\n")
+    return run.name
+
+def read_run(filename):
+    """ Yields the books in a file written by write_run """
+    with open(filename, 'r', encoding='utf-8') as file:
+        for line in file:
+            title, author, callnum = line.rstrip('\n').split('\t')
+            yield Book(callnum, title, author)
+
+def sort_catalog(filename, run_size=RUN_SIZE, directory=None):
+    """ Yields the books in a catalog file in call number order, without holding the whole catalog in memory
+
+    The catalog is read run_size books at a time; each run is sorted and
+    written to a temporary file, and the runs are then merged. The order
+    is the same as sorting the whole catalog at once. """
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        runs = []
+        with open(filename, 'r', encoding='utf-8') as file:
+            while True:
+                lines = list(itertools.islice(file, run_size))
+                if not lines:
+                    break
+                books = [parse_line(line) for line in lines]
+                books.sort(key=attrgetter("key"))
+                runs.append(write_run(books, tmp))
+        yield from heapq.merge(*(read_run(run) for run in runs), key=attrgetter("key"))
+
+def chunk_ranges(filename, chunk_bytes=CHUNK_BYTES):
+    """ Splits a file into byte ranges of about chunk_bytes that start and end on line boundaries """
+    size = os.path.getsize(filename)
+    ranges = []
+    with open(filename, 'rb') as file:
+        start = 0
+        while start < size:
+            file.seek(min(start + chunk_bytes, size))
+            file.readline()
+            end = min(file.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+def sort_chunk(filename, start, end, directory):
+    """ Parses and sorts one byte range of a catalog into a run file; runs in a worker process for ingest_catalog
+
+    Returns the run's file name and the rejected lines as (byte offset, reason, line) """
+    books = []
+    rejects = []
+    with open(filename, 'rb') as file:
+        file.seek(start)
+        offset = start
+        for raw in file.read(end - start).splitlines(keepends=True):
+            try:
+                books.append(parse_line(raw.decode('utf-8')))
+            except UnicodeDecodeError:
+                rejects.append((offset, "not valid UTF-8", raw.decode('utf-8', 'replace').rstrip('\r\n')))
+            except ValueError as e:
+                rejects.append((offset, str(e), raw.decode('utf-8').rstrip('\r\n')))
+            offset += len(raw)
+    books.sort(key=attrgetter("key"))
+    return write_run(books, directory), rejects
+
+def write_rejects(rejects, filename):
+    """ Writes rejected lines to a tab-separated report of byte offset, reason and line """
+    with open(filename, 'w', encoding='utf-8') as report:
+        for offset, reason, line in rejects:
+            report.write(f"{offset}\t{reason}\t{line}\n")
+
+def ingest_catalog(filename, processes=None, chunk_bytes=CHUNK_BYTES, reject_file=None, directory=None):
+    """ Yields the books in a catalog file in call number order, parsing it in parallel
+
+    The file is split into byte ranges, and a pool of processes parses
+    and sorts each range into a run file; the runs are then merged, giving
+    the same order as sort_catalog. Malformed lines don't stop the
+    ingest: they are written to reject_file (if given) with their byte
+    offsets once every range has been parsed. """
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        ranges = chunk_ranges(filename, chunk_bytes)
+        with ProcessPoolExecutor(processes) as pool:
+            results = list(pool.map(sort_chunk, itertools.repeat(filename), *zip(*ranges), itertools.repeat(tmp))) if ranges else []
+        if reject_file is not None:
+            write_rejects([reject for run, rejects in results for reject in rejects], reject_file)
+        yield from heapq.merge(*(read_run(run) for run, rejects in results), key=attrgetter("key"))
+
 def print_books(books):
     """ Printing information about each book, in order. """
-    for book in sorted(books):
+    for book in sorted(books, key=attrgetter("key")):
         print(book)
 
-def main(filename):
-    """ Read book information from a file, sort the books by call number, and print information about each book. """
-    books = read_books(filename)
-    print_books(books)
+def main(filename, external=False, run_size=RUN_SIZE, parallel=False, processes=None, reject_file=None):
+    """ Read book information from a file, sort the books by call number, and print information about each book.
+
+    With external, the catalog is sorted in runs on disk instead of in
+    memory. With parallel, it is parsed by a pool of processes, and
+    malformed lines are written to reject_file instead of stopping. """
+    if parallel:
+        for book in ingest_catalog(filename, processes, reject_file=reject_file):
+            print(book)
+    elif external:
+        for book in sort_catalog(filename, run_size):
+            print(book)
+    else:
+        books = read_books(filename)
+        print_books(books)
+
+def lookup_main(filename, index_file, between=None, after=None, count=20, letters=None):
+    """ Look books up in the shelf index of a catalog and print them.
+
+    The index is built and saved to index_file the first time, and again whenever the catalog changes. """
+    index = ShelfIndex.for_catalog(filename, index_file)
+    if between:
+        books = index.between(*between)
+    elif after:
+        books = index.after(after, count)
+    else:
+        books = index.with_class(letters)
+    for book in books:
+        print(book)
 
 def parse_args(arglist):
     """ Parse command-line arguments. """
     parser = ArgumentParser()
     parser.add_argument("filename", help="file containing book information")
+    parser.add_argument("--external", action="store_true", help="sort in runs on disk, for catalogs larger than memory")
+    parser.add_argument("--run-size", type=int, default=RUN_SIZE, help=f"books per sorted run with --external (default: {RUN_SIZE})")
+    parser.add_argument("--parallel", action="store_true", help="parse and sort in parallel, skipping malformed lines")
+    parser.add_argument("--processes", type=int, help="number of worker processes for --parallel (default: one per CPU)")
+    parser.add_argument("--rejects", help="where --parallel reports malformed lines (default: filename + '.rejects')")
+    parser.add_argument("--index", help="shelf index file to use for --between, --after and --class (default: filename + '.index')")
+    lookups = parser.add_mutually_exclusive_group()
+    lookups.add_argument("--between", nargs=2, metavar=("LOW", "HIGH"), help="print the books from call number LOW through HIGH")
+    lookups.add_argument("--after", metavar="CALLNUM", help="print the next --count books after CALLNUM")
+    lookups.add_argument("--class", dest="letters", metavar="LETTERS", help="print the books whose class starts with LETTERS")
+    parser.add_argument("--count", type=int, default=20, help="number of books for --after (default: 20)")
     return parser.parse_args(arglist)
 
 if __name__ == "__main__":
     args = parse_args(sys.argv[1:])
-    main(args.filename)
+    if args.between or args.after or args.letters:
+        try:
+            lookup_main(args.filename, args.index or args.filename + ".index",
+                        args.between, args.after, args.count, args.letters)
+        except ValueError as e:
+            sys.exit(str(e))
+    else:
+        main(args.filename, args.external, args.run_size, args.parallel, args.processes,
+             args.rejects or args.filename + ".rejects")
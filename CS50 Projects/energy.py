@@ -2,26 +2,226 @@
 
 
 from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import functools
+import glob
+import hashlib
+import io
+import itertools
+import os
 import sqlite3
 import sys
 
 
+# Bulk loading settings: no rollback journal or fsyncs are needed for an
+# in-memory database that is rebuilt from the CSV on every run
+PRAGMAS = ("PRAGMA journal_mode = MEMORY", "PRAGMA synchronous = OFF")
+
+# A database file has to survive crashes, but WAL mode only needs to sync
+# at checkpoints
+FILE_PRAGMAS = ("PRAGMA journal_mode = WAL", "PRAGMA synchronous = NORMAL")
+
+SCHEMA = ("""CREATE TABLE IF NOT EXISTS production
+             (year integer, state text, source text, mwh real, file_id integer)""",
+          """CREATE TABLE IF NOT EXISTS ingested_files
+             (id integer PRIMARY KEY, path text UNIQUE, size integer, mtime_ns integer, sha256 text)""",
+          # production summed by every dimension, which all grouped queries read from
+          """CREATE TABLE IF NOT EXISTS production_rollup
+             (year integer, state text, source text, mwh real, rows integer, UNIQUE (year, state, source))""",
+          # production rows up to last_rowid have been added to the rollup
+          """CREATE TABLE IF NOT EXISTS rollup_state
+             (id integer PRIMARY KEY CHECK (id = 0), last_rowid integer)""",
+          "INSERT OR IGNORE INTO rollup_state VALUES (0, 0)",
+          # every query reads the rollup now, so production needs no index to slow loading down
+          "DROP INDEX IF EXISTS production_source_year")
+
+# Adds production rows in a rowid range to the rollup (or, with the sign
+# flipped, takes them out)
+ROLLUP_UPSERT = """INSERT INTO production_rollup
+                   SELECT year, state, source, {sign}SUM(mwh), {sign}COUNT(*) FROM production
+                   WHERE {where} GROUP BY year, state, source
+                   ON CONFLICT (year, state, source) DO UPDATE
+                   SET mwh = mwh + excluded.mwh, rows = rows + excluded.rows"""
+
+# Columns that grouped queries can group and filter by
+DIMENSIONS = ("year", "state", "source")
+
+# Number of distinct grouped query results kept in memory
+QUERY_CACHE_SIZE = 1024
+
+# Rows collected from parsed files before read_many writes them
+WRITE_BATCH_ROWS = 100000
+
+
+def hash_file(filename, start, end, digest=None):
+    """ Hash part of a file.
+
+    Args:
+        filename (str): path to the file.
+        start (int): offset of the first byte to hash.
+        end (int): offset just past the last byte to hash.
+        digest (hashlib object): hash to continue (default: a new sha256).
+
+    Returns:
+        hashlib object: the hash, which can be updated further.
+    """
+    if digest is None:
+        digest = hashlib.sha256()
+    size = end - start
+    with open(filename, 'rb') as file:
+        file.seek(start)
+        while size > 0:
+            block = file.read(min(size, 1 << 20))
+            if not block:
+                break
+            digest.update(block)
+            size -= len(block)
+    return digest
+
+
+def plan_read(path, known):
+    """ Work out which part of a CSV file still has to be read.
+
+    Args:
+        path (str): path to the CSV file.
+        known (tuple): size and sha256 of the file when it was last read,
+            or None if it hasn't been read.
+
+    Returns:
+        tuple: offset to start reading at (0 to read the whole file), and
+            the file's size, mtime in ns and sha256.
+    """
+    stat = os.stat(path)
+    offset = 0
+    # appended rows can only be read on their own if the old data ended
+    # with a complete line; otherwise they'd join onto its last row
+    if known is not None and stat.st_size >= known[0] and ends_with_newline(path, known[0]):
+        digest = hash_file(path, 0, known[0])
+        if digest.hexdigest() == known[1]:
+            offset = known[0]
+    if offset:
+        digest = hash_file(path, offset, stat.st_size, digest)
+    else:
+        digest = hash_file(path, 0, stat.st_size)
+    return offset, stat.st_size, stat.st_mtime_ns, digest.hexdigest()
+
+
+def ends_with_newline(path, size):
+    """ Whether the first size bytes of a file end with a newline. """
+    if size == 0:
+        return False
+    with open(path, 'rb') as file:
+        file.seek(size - 1)
+        return file.read(1) == b"\n"
+
+
+def read_rows(path, offset=0):
+    """ Read and check production rows from a CSV file.
+
+    Args:
+        path (str): path to the CSV file.
+        offset (int): where to start reading; the header is skipped when
+            this is 0 (default: 0).
+
+    Yields:
+        tuple: year (int), state (str), source (str), mwh (float).
+
+    Raises:
+        ValueError: a row doesn't have four columns, or its year or
+            megawatthours isn't a number.
+    """
+    with open(path, 'rb') as raw:
+        raw.seek(offset)
+        reader = csv.reader(io.TextIOWrapper(raw, newline=''))
+        if offset == 0:
+            next(reader, None)
+        for row in reader:
+            try:
+                year, state, source, mwh = row
+                yield int(year), state, source, float(mwh)
+            except ValueError as e:
+                where = f"line {reader.line_num}" + (f" after byte {offset}" if offset else "")
+                raise ValueError(f"{path}, {where}: {e}") from None
+
+
+def parse_file(path, known):
+    """ Plan and read one file; run in a worker process by read_many.
+
+    Args:
+        path (str): path to the CSV file.
+        known (tuple): see plan_read.
+
+    Returns:
+        tuple: path, the plan from plan_read, and a list of the rows read.
+    """
+    plan = plan_read(path, known)
+    return path, plan, list(read_rows(path, plan[0]))
+
+
+def expand_files(files):
+    """ Turn a glob pattern or list of paths and patterns into a list of paths.
+
+    Args:
+        files (str or iterable of str): glob patterns or file paths.
+
+    Returns:
+        list of str: absolute paths, sorted and without repeats.
+    """
+    if isinstance(files, str):
+        files = [files]
+    paths = set()
+    for pattern in files:
+        matches = glob.glob(pattern) if glob.has_magic(pattern) else [pattern]
+        paths.update(os.path.abspath(match) for match in matches)
+    return sorted(paths)
+
+
 class EnergyDB:
     
-    """ In-memory sqlite database for energy production data in the US by year and energy source
+    """ Sqlite database for energy production data in the US by year and energy source
+
+    The database is in memory unless a database file is given. A database
+    file remembers which CSV files were read into it, so they are only
+    read again when they change.
+
+    Grouped queries (aggregate, year_over_year, top_states) read from a
+    rollup table of totals by year, state and source, and their results
+    are cached until the next time data is read in. Rows are added to the
+    rollup by the first query after they are read, rather than while
+    loading, and only rows that aren't in it yet are added.
 
     Properties:
     conn (sqlite3.Connection): The connection to the sqlite database """
     
-    def __init__(self, filename):
+    def __init__(self, filename=None, db_path=':memory:'):
         
-        """ Initialize the class. Connect to the sqlite database and also read data from the csv file
+        """ Initialize the class. Connect to the sqlite database and also read data from the csv file(s)
 
         Args:
-        filename (str): Route to the csv file """
+        filename (str or list of str): Route to the csv file, or glob pattern(s)
+            and routes to read with read_many (default: read nothing)
+        db_path (str): Route to the sqlite database file (default: in memory) """
 
-        self.conn = sqlite3.connect(':memory:')
-        self.read(filename)
+        self.conn = sqlite3.connect(db_path)
+        self.cached_query = functools.lru_cache(maxsize=QUERY_CACHE_SIZE)(self.run_query)
+        for pragma in (PRAGMAS if db_path == ':memory:' else FILE_PRAGMAS):
+            self.conn.execute(pragma)
+        with self.conn:
+            for statement in SCHEMA:
+                self.conn.execute(statement)
+            # rollups from before row counts were kept are rebuilt
+            if "rows" not in [column[1] for column in self.conn.execute("PRAGMA table_info(production_rollup)")]:
+                self.conn.execute("DROP TABLE production_rollup")
+                self.conn.execute(SCHEMA[2])
+                self.conn.execute("UPDATE rollup_state SET last_rowid = 0")
+        if filename is None:
+            return
+        if isinstance(filename, str) and not glob.has_magic(filename):
+            self.read(filename)
+        else:
+            self.read_many(filename)
     
     def __del__(self):
         """ Clean up the database connection. """
@@ -34,19 +234,289 @@ class EnergyDB:
         
         """ Reading the CSV and inputting data into the sqlite database
 
+        Rows are streamed from the csv reader into a single executemany
+        call inside one transaction. The production table has no indexes
+        to update, and the rollup is brought up to date by the next query.
+
+        A file that was already read is skipped if its size and
+        modification time are unchanged. If it only had rows appended
+        after a complete last line, only the new rows are read; otherwise
+        its old rows are replaced.
+
         Args:
         filename (str): Route to the csv file """
 
-        cursor = self.conn.cursor()
-        cursor.execute(""" CREATE TABLE production (year integer, state text, source text, mwh real)""")
+        path = os.path.abspath(filename)
+        known = self.changed_file(path)
+        if known is False:
+            return
+        plan = plan_read(path, known)
+
+        with self.conn:
+            file_id = self.store_file(path, *plan)
+            # file_id is a rowid from ingested_files, so it's safe to put in the statement
+            self.conn.executemany(f"INSERT INTO production VALUES (?, ?, ?, ?, {int(file_id)})",
+                                  read_rows(path, plan[0]))
+            self.finish_load()
+
+    def read_many(self, files, processes=None):
+        
+        """ Read many CSV files, parsing them in parallel
+
+        Files are parsed and checked in a pool of worker processes, and
+        their rows are written in large batches by this process, so the
+        database only ever has one writer. Files are skipped or read in
+        part the same way as in read. Nothing is written if any file has
+        a bad row.
+
+        Args:
+        files (str or list of str): Glob pattern(s) or routes to csv files
+        processes (int): Number of worker processes (default: one per CPU)
+
+        Raises:
+        ValueError: A file has a bad row """
+
+        jobs = []
+        for path in expand_files(files):
+            known = self.changed_file(path)
+            if known is not False:
+                jobs.append((path, known))
+        if not jobs:
+            return
+        if len(jobs) == 1:
+            # no point starting worker processes for one file
+            return self.read(jobs[0][0])
+
+        processes = processes or os.cpu_count() or 1
+        with self.conn, ProcessPoolExecutor(processes) as pool:
+            # keep a few files per worker in flight so parsed rows can't pile up
+            jobs = iter(jobs)
+            pending = deque(pool.submit(parse_file, *job) for job in itertools.islice(jobs, 4 * processes))
+            batch = []
+            while pending:
+                path, plan, rows = pending.popleft().result()
+                for job in itertools.islice(jobs, 1):
+                    pending.append(pool.submit(parse_file, *job))
+                file_id = self.store_file(path, *plan)
+                batch.extend(row + (file_id,) for row in rows)
+                if len(batch) >= WRITE_BATCH_ROWS:
+                    self.conn.executemany("INSERT INTO production VALUES (?, ?, ?, ?, ?)", batch)
+                    batch = []
+            self.conn.executemany("INSERT INTO production VALUES (?, ?, ?, ?, ?)", batch)
+            self.finish_load()
+
+    def changed_file(self, path):
+        
+        """ Check whether a csv file changed since it was last read
+
+        Args:
+        path (str): Absolute route to the csv file
+
+        Returns:
+        tuple or None or bool: False if the file is unchanged, None if it was
+            never read, otherwise its size and sha256 when it was last read """
+
+        stat = os.stat(path)
+        known = self.conn.execute("SELECT size, mtime_ns, sha256 FROM ingested_files WHERE path=?",
+                                  (path,)).fetchone()
+        if known is None:
+            return None
+        if known[:2] == (stat.st_size, stat.st_mtime_ns):
+            return False
+        return known[0], known[2]
+
+    def store_file(self, path, offset, size, mtime_ns, sha256):
         
-        with open(filename, 'r') as file:
-            next(file)
-            for line in file:
-                year, state, source, mwh = line.strip().split(',')
-                cursor.execute("INSERT INTO production VALUES (?, ?, ?, ?)", (int(year), state, source, float(mwh)))
+        """ Record that a csv file is being read, dropping its old rows if it will be read in full
+
+        Args:
+        path (str): Absolute route to the csv file
+        offset, size, mtime_ns, sha256: The plan from plan_read
+
+        Returns:
+        int: The file's id, for its production rows """
+
+        known = self.conn.execute("SELECT id FROM ingested_files WHERE path=?", (path,)).fetchone()
+        if known is None:
+            file_id = self.conn.execute("INSERT INTO ingested_files (path) VALUES (?)", (path,)).lastrowid
+        else:
+            file_id = known[0]
+            if offset == 0:
+                self.remove_rows(file_id)
+        self.conn.execute("UPDATE ingested_files SET size=?, mtime_ns=?, sha256=? WHERE id=?",
+                          (size, mtime_ns, sha256, file_id))
+        return file_id
+
+    def remove_rows(self, file_id):
+        
+        """ Delete a csv file's rows, taking the ones already in the rollup back out of it
+
+        Args:
+        file_id (int): The file's id """
+
+        last_rowid = self.conn.execute("SELECT last_rowid FROM rollup_state").fetchone()[0]
+        self.conn.execute(ROLLUP_UPSERT.format(sign="-", where="file_id = ? AND rowid <= ?"),
+                          (file_id, last_rowid))
+        self.conn.execute("DELETE FROM production_rollup WHERE rows = 0")
+        self.conn.execute("DELETE FROM production WHERE file_id=?", (file_id,))
+        # new rows may reuse the rowids of deleted ones at the end of the table
+        self.conn.execute("""UPDATE rollup_state
+                             SET last_rowid = MIN(last_rowid, COALESCE((SELECT MAX(rowid) FROM production), 0))""")
+
+    def finish_load(self):
+        
+        """ Forget cached query results after new rows are written """
+
+        self.cached_query.cache_clear()
+
+    def update_rollup(self):
+        
+        """ Add production rows that were read since the last update to the rollup """
+
+        last_rowid = self.conn.execute("SELECT last_rowid FROM rollup_state").fetchone()[0]
+        top = self.conn.execute("SELECT MAX(rowid) FROM production").fetchone()[0]
+        if top is None or top <= last_rowid:
+            return
+        with self.conn:
+            self.conn.execute(ROLLUP_UPSERT.format(sign="", where="rowid > ? AND rowid <= ?"), (last_rowid, top))
+            self.conn.execute("UPDATE rollup_state SET last_rowid = ?", (top,))
+
+    def refresh_rollup(self):
+        
+        """ Rebuild the rollup table from the production table and forget cached query results """
+
+        with self.conn:
+            self.conn.execute("DELETE FROM production_rollup")
+            self.conn.execute("UPDATE rollup_state SET last_rowid = 0")
+        self.update_rollup()
+        self.cached_query.cache_clear()
+
+    def run_query(self, sql, params):
+        
+        """ Run a query and return its results as columns
+
+        Args:
+        sql (str): The query
+        params (tuple): Values for the query's placeholders
+
+        Returns:
+        dict: Each column name mapped to a tuple of that column's values """
+
+        self.update_rollup()
+        cursor = self.conn.execute(sql, params)
+        names = [column[0] for column in cursor.description]
+        rows = cursor.fetchall()
+        columns = list(zip(*rows)) if rows else [()] * len(names)
+        return dict(zip(names, columns))
+
+    def query(self, sql, params=()):
+        
+        """ Run a query through the cache
+
+        Returns:
+        dict: Each column name mapped to a tuple of that column's values """
+
+        return dict(self.cached_query(sql, tuple(params)))
+
+    def where(self, filters):
         
-        self.conn.commit()
+        """ Build a WHERE clause for filters on the dimensions
+
+        Args:
+        filters (dict): Dimension name mapped to one value or a list of values
+
+        Returns:
+        tuple: The clause (empty if there are no filters) and its parameters """
+
+        clauses = []
+        params = []
+        for name, value in sorted(filters.items()):
+            if name not in DIMENSIONS:
+                raise ValueError(f"can't filter by {name!r}, expected one of {DIMENSIONS}")
+            values = list(value) if isinstance(value, (list, tuple, set, frozenset)) else [value]
+            clauses.append(f"{name} IN ({', '.join('?' * len(values))})")
+            params.extend(sorted(values) if isinstance(value, (set, frozenset)) else values)
+        return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+    def check_dimensions(self, by):
+        
+        """ Make sure every name in by is a dimension
+
+        Raises:
+        ValueError: A name isn't one of DIMENSIONS """
+
+        for name in by:
+            if name not in DIMENSIONS:
+                raise ValueError(f"can't group by {name!r}, expected one of {DIMENSIONS}")
+
+    def aggregate(self, by=("source",), **filters):
+        
+        """ Total production grouped by any of year, state and source
+
+        Args:
+        by (sequence of str): Dimensions to group by, in order (default: source)
+        filters: Dimension name mapped to one value or a list of values to keep,
+            ex. year=2017 or source=["Wind", "Solar Thermal and Photovoltaic"]
+
+        Returns:
+        dict: A column of values for each dimension in by, plus an mwh column
+            of totals, sorted by the dimensions
+
+        Raises:
+        ValueError: An unknown dimension was used """
+
+        by = tuple(by)
+        self.check_dimensions(by)
+        where, params = self.where(filters)
+        columns = ", ".join(by)
+        if by:
+            sql = (f"SELECT {columns}, SUM(mwh) AS mwh FROM production_rollup{where}"
+                   f" GROUP BY {columns} ORDER BY {columns}")
+        else:
+            sql = f"SELECT COALESCE(SUM(mwh), 0) AS mwh FROM production_rollup{where}"
+        return self.query(sql, params)
+
+    def year_over_year(self, by=("source",), **filters):
+        
+        """ Total production by year, with the change from the year before
+
+        Args:
+        by (sequence of str): Dimensions besides year to group by (default: source)
+        filters: Same as for aggregate
+
+        Returns:
+        dict: The columns from aggregate with year added after the by columns,
+            plus a delta column that is None for each group's first year
+
+        Raises:
+        ValueError: An unknown dimension was used """
+
+        by = tuple(name for name in by if name != "year")
+        self.check_dimensions(by)
+        where, params = self.where(filters)
+        columns = ", ".join(by + ("year",))
+        partition = f"PARTITION BY {', '.join(by)} " if by else ""
+        sql = (f"SELECT {columns}, mwh, mwh - LAG(mwh) OVER ({partition}ORDER BY year) AS delta"
+               f" FROM (SELECT {columns}, SUM(mwh) AS mwh FROM production_rollup{where} GROUP BY {columns})"
+               f" ORDER BY {columns}")
+        return self.query(sql, params)
+
+    def top_states(self, source, n=10, **filters):
+        
+        """ The states that produced the most energy from a source
+
+        Args:
+        source (str): What energy source to rank states by, ex. Wind
+        n (int): How many states to return (default: 10)
+        filters: Same as for aggregate, ex. year=2017
+
+        Returns:
+        dict: state and mwh columns, largest first """
+
+        where, params = self.where(dict(filters, source=source))
+        sql = (f"SELECT state, SUM(mwh) AS mwh FROM production_rollup{where}"
+               f" GROUP BY state ORDER BY mwh DESC, state LIMIT ?")
+        return self.query(sql, params + [n])
 
     def production_by_source(self, source, year):
         
@@ -59,24 +529,26 @@ class EnergyDB:
         Returns:
         float: Total mega watt hours from the chosen energy source for the chosen year"""
 
+        self.update_rollup()
         cursor = self.conn.cursor()
-        cursor.execute("SELECT mwh FROM production WHERE source=? AND year=?", (source, year))
-        results = cursor.fetchall()
-        total_mwh = sum(row[0] for row in results)
+        cursor.execute("SELECT COALESCE(SUM(mwh), 0) FROM production_rollup WHERE source=? AND year=?", (source, year))
+        total_mwh = cursor.fetchone()[0]
         return total_mwh
 
-def main(filename):
+def main(files, db_path=':memory:'):
     """ Build a database of energy sources and calculate the total production
     of solar and wind energy.
     
     Args:
-        filename (str): path to a CSV file containing four columns:
-            Year, State, Energy Source, Megawatthours.
+        files (list of str): paths or glob patterns of CSV files containing
+            four columns: Year, State, Energy Source, Megawatthours.
+        db_path (str): path to a sqlite database file to keep the data in
+            between runs (default: in memory).
     
     Side effects:
         Writes to stdout.
     """
-    e = EnergyDB(filename)
+    e = EnergyDB(files, db_path)
     sources = [("solar", "Solar Thermal and Photovoltaic"),
                ("wind", "Wind")]
     for source_lbl, source_str in sources:
@@ -87,10 +559,13 @@ def main(filename):
 def parse_args(arglist):
     """ Parse command-line arguments. """
     parser = ArgumentParser()
-    parser.add_argument("file", help="path to energy CSV file")
+    parser.add_argument("files", nargs="+", help="paths or glob patterns of energy CSV files")
+    parser.add_argument("--db", default=":memory:",
+                        help="sqlite database file to keep the data in between"
+                             " runs, so unchanged CSV files aren't read again")
     return parser.parse_args(arglist)
 
 
 if __name__ == "__main__":
     args = parse_args(sys.argv[1:])
-    main(args.file)
+    main(args.files, args.db)
@@ -1,118 +1,661 @@
-"""Mortgage calculator (fixed rate)"""
-
-from argparse import ArgumentParser
-import math
-import sys
-
-def get_min_payment(principal, annual_interest_rate, term=30, payments_per_year=12):
-    """Minimum mortgage payment:
-
-    Args:
-        principal (float): Total mortgage
-        annual_interest_rate (float): Annual interest (between 0 and 1)
-        term (int): Number of years for mortgage (default: 30)
-        payments_per_year (int): Payments (months) per year (default: 12)
-
-    Returns:
-        int: The minimum mortgage payment (math.ceil makes it to the next highest integer value)
-    """
-    r = annual_interest_rate / payments_per_year
-    n = term * payments_per_year
-    A = (principal * r * (1 + r)**n) / ((1 + r)**n - 1)
-    return math.ceil(A)
-
-def interest_due(balance, annual_interest_rate, payments_per_year=12):
-    """Interest for next payment
-
-    Args:
-        balance (float): The balance (principal that hasn't been paid yet)
-        annual_interest_rate (float): Annual interest (between 0 and 1)
-        payments_per_year (int): Payments (months) per year (default: 12)
-
-    Returns:
-        float: The amount of interest due for next payment
-    """
-    r = annual_interest_rate / payments_per_year
-    return balance * r
-
-def remaining_payments(balance, annual_interest_rate, target_payment, payments_per_year=12):
-    """Number of payments to make
-
-    Args:
-        balance (float): The balance (principal that hasn't been paid yet)
-        annual_interest_rate (float): Annual interest (between 0 and 1)
-        target_payment (float): How much user wants to pay per payment
-        payments_per_year (int): Payments (months) per year (default: 12)
-
-    Returns:
-        int: The number of payments needed to pay the mortgage
-    """
-    counter = 0
-    while balance > 0:
-        interest = interest_due(balance, annual_interest_rate, payments_per_year)
-        principal_payment = target_payment - interest
-        balance -= principal_payment
-        counter += 1
-    return counter
-
-def main(principal, annual_interest_rate, term=30, payments_per_year=12, target_payment=None):
-    """Main function to calculate and display results
-
-    Args:
-        principal (float): Total mortgage
-        annual_interest_rate (float): Annual interest (between 0 and 1)
-        term (int): Number of years for mortgage (default: 30)
-        payments_per_year (int): Payments (months) per year (default: 12)
-        target_payment (float): How much user wants to pay per payment (default: None)
-    """
-    min_payment = get_min_payment(principal, annual_interest_rate, term, payments_per_year)
-    print(f"Minimum payment: ${min_payment}")
-
-    if target_payment is None:
-        target_payment = min_payment
-
-    if target_payment < min_payment:
-        print("Target payment is less than minimum payment")
-    else:
-        total_payments = remaining_payments(principal, annual_interest_rate, target_payment, payments_per_year)
-        print(f"With payments of ${target_payment}, the mortgage will be paid in {total_payments} payments.")
-
-def parse_args(arglist):
-    """Parse and validate command-line arguments.
-
-    Args:
-        arglist (list of str): List of command-line arguments.
-
-    Returns:
-        namespace: The parsed arguments (see argparse documentation for more information).
-
-    Raises:
-        ValueError: Encountered an invalid argument.
-    """
-    parser = ArgumentParser()
-    parser.add_argument("mortgage_amount", type=float, help="the total amount of the mortgage")
-    parser.add_argument("annual_interest_rate", type=float, help="the annual interest rate, as a float between 0 and 1")
-    parser.add_argument("-y", "--years", type=int, default=30, help="the term of the mortgage in years (default: 30)")
-    parser.add_argument("-n", "--num_annual_payments", type=int, default=12, help="the number of payments per year (default: 12)")
-    parser.add_argument("-p", "--target_payment", type=float, help="the amount you want to pay per payment (default: the minimum payment)")
-    
-    args = parser.parse_args(arglist)
-    if args.mortgage_amount <= 0:
-        raise ValueError("mortgage amount must be positive")
-    if not 0 <= args.annual_interest_rate <= 1:
-        raise ValueError("annual interest rate must be between 0 and 1")
-    if args.years <= 0:
-        raise ValueError("years must be positive")
-    if args.num_annual_payments <= 0:
-        raise ValueError("number of payments per year must be positive")
-    if args.target_payment is not None and args.target_payment <= 0:
-        raise ValueError("target payment must be positive")
-
-    return args
-
-if __name__ == "__main__":
-    try:
-        args = parse_args(sys.argv[1:])
-    except ValueError as e:
-        sys.exit(str(e))
-    main(args.mortgage_amount, args.annual_interest_rate, args.years, args.num_annual_payments, args.target_payment)
+"""Mortgage calculator (fixed rate)"""
+
+from argparse import ArgumentParser
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import functools
+import io
+import itertools
+import math
+import os
+import sys
+import numpy as np
+
+Schedule = namedtuple("Schedule", ["payment", "interest", "principal", "balance"])
+
+# Columns of a batch file of loans, and the values used when one is missing or blank
+LOAN_COLUMNS = ("principal", "annual_interest_rate", "term", "payments_per_year", "target_payment")
+LOAN_DEFAULTS = {"term": 30, "payments_per_year": 12, "target_payment": math.nan}
+# Columns added to each loan in the batch output
+RESULT_COLUMNS = ("min_payment", "payments", "total_interest", "status")
+# Loans handed to a worker process at a time
+BATCH_ROWS = 50000
+# Percentiles reported by simulate_portfolio
+PERCENTILES = (5, 25, 50, 75, 95)
+# Number of answers kept by the cached what-if solvers
+SOLVER_CACHE_SIZE = 4096
+
+def get_min_payment(principal, annual_interest_rate, term=30, payments_per_year=12):
+    """Minimum mortgage payment:
+
+    Args:
+        principal (float): Total mortgage
+        annual_interest_rate (float): Annual interest (between 0 and 1)
+        term (int): Number of years for mortgage (default: 30)
+        payments_per_year (int): Payments (months) per year (default: 12)
+
+    Returns:
+        int: The minimum mortgage payment (math.ceil makes it to the next highest integer value)
+    """
+    r = annual_interest_rate / payments_per_year
+    n = term * payments_per_year
+    A = (principal * r * (1 + r)**n) / ((1 + r)**n - 1)
+    return math.ceil(A)
+
+def interest_due(balance, annual_interest_rate, payments_per_year=12):
+    """Interest for next payment
+
+    Args:
+        balance (float): The balance (principal that hasn't been paid yet)
+        annual_interest_rate (float): Annual interest (between 0 and 1)
+        payments_per_year (int): Payments (months) per year (default: 12)
+
+    Returns:
+        float: The amount of interest due for next payment
+    """
+    r = annual_interest_rate / payments_per_year
+    return balance * r
+
+def balance_after(principal, annual_interest_rate, target_payment, payments, payments_per_year=12):
+    """Balance left after a number of payments, in closed form
+
+    Args:
+        principal (float or array): The starting balance
+        annual_interest_rate (float or array): Annual interest (between 0 and 1)
+        target_payment (float or array): How much user pays per payment
+        payments (int or array): Number of payments made
+        payments_per_year (int or array): Payments (months) per year (default: 12)
+
+    Returns:
+        float or array: The balance, negative if the last payment overpaid
+    """
+    r = np.asarray(annual_interest_rate, dtype=np.float64) / payments_per_year
+    growth = np.power(1 + r, payments)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        paid = np.where(r > 0, target_payment * np.expm1(np.log1p(r) * payments) / r,
+                        np.multiply(target_payment, payments, dtype=np.float64))
+    return principal * growth - paid
+
+def remaining_payments(balance, annual_interest_rate, target_payment, payments_per_year=12):
+    """Number of payments to make
+
+    Uses the annuity formula n = log(A / (A - rB)) / log(1 + r) instead of
+    stepping through each payment. All arguments may also be NumPy arrays,
+    to count payments for many loans at once.
+
+    Args:
+        balance (float): The balance (principal that hasn't been paid yet)
+        annual_interest_rate (float): Annual interest (between 0 and 1)
+        target_payment (float): How much user wants to pay per payment
+        payments_per_year (int): Payments (months) per year (default: 12)
+
+    Returns:
+        int: The number of payments needed to pay the mortgage
+
+    Raises:
+        ValueError: The target payment doesn't cover the interest, so the mortgage is never paid
+    """
+    balance, rate, payment, per_year = np.broadcast_arrays(
+        np.asarray(balance, dtype=np.float64), np.asarray(annual_interest_rate, dtype=np.float64),
+        np.asarray(target_payment, dtype=np.float64), np.asarray(payments_per_year))
+    r = rate / per_year
+    owed = np.maximum(balance, 0)
+    if np.any((owed > 0) & (payment <= owed * r)):
+        raise ValueError("target payment does not cover the interest")
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        exact = np.where(r > 0, np.log(payment / (payment - owed * r)) / np.log1p(r), owed / payment)
+    counts = np.ceil(np.where(owed > 0, exact, 0))
+    # the logs can land a hair either side of a whole number of payments
+    counts -= (counts > 0) & (balance_after(owed, rate, payment, counts - 1, per_year) <= 0)
+    counts += (owed > 0) & (balance_after(owed, rate, payment, counts, per_year) > 0)
+    counts = counts.astype(np.int64)
+    return int(counts) if counts.ndim == 0 else counts
+
+def amortization_schedule(principal, annual_interest_rate, target_payment, payments_per_year=12):
+    """Payment-by-payment breakdown of a mortgage
+
+    Every period is computed at once from the closed-form balance, rather
+    than by stepping through the payments. The last payment is only as
+    large as what is left to pay.
+
+    If any argument is a NumPy array, the schedules of all the loans are
+    returned as rows of 2D arrays, padded with zeros after each loan is
+    paid off.
+
+    Args:
+        principal (float or array): Total mortgage
+        annual_interest_rate (float or array): Annual interest (between 0 and 1)
+        target_payment (float or array): How much user wants to pay per payment
+        payments_per_year (int or array): Payments (months) per year (default: 12)
+
+    Returns:
+        Schedule: payment, interest, principal and balance arrays, one entry per payment
+
+    Raises:
+        ValueError: The target payment doesn't cover the interest
+    """
+    scalar = all(np.ndim(arg) == 0 for arg in (principal, annual_interest_rate, target_payment, payments_per_year))
+    counts = np.atleast_1d(remaining_payments(principal, annual_interest_rate, target_payment, payments_per_year))
+    principal, rate, payment, per_year = (np.atleast_1d(arg)[:, np.newaxis] for arg in np.broadcast_arrays(
+        np.asarray(principal, dtype=np.float64), np.asarray(annual_interest_rate, dtype=np.float64),
+        np.asarray(target_payment, dtype=np.float64), np.asarray(payments_per_year)))
+    periods = np.arange(int(counts.max(initial=0)) + 1)
+
+    balance = np.maximum(balance_after(principal, rate, payment, periods, per_year), 0)
+    balance[periods > counts[:, np.newaxis]] = 0
+    interest = balance[:, :-1] * (rate / per_year)
+    principal_paid = balance[:, :-1] - balance[:, 1:]
+    schedule = Schedule(interest + principal_paid, interest, principal_paid, balance[:, 1:])
+    return Schedule(*(column[0] for column in schedule)) if scalar else schedule
+
+def min_payments(principal, annual_interest_rate, term=30, payments_per_year=12):
+    """Minimum payments for many mortgages at once, like get_min_payment
+
+    Args:
+        principal (array): Total mortgages
+        annual_interest_rate (array): Annual interest (between 0 and 1)
+        term (array): Number of years for each mortgage (default: 30)
+        payments_per_year (array): Payments (months) per year (default: 12)
+
+    Returns:
+        array: The minimum payments, rounded up to whole dollars
+    """
+    return np.ceil(annuity_payment(principal, annual_interest_rate,
+                                   np.multiply(term, payments_per_year), payments_per_year))
+
+def annuity_payment(principal, annual_interest_rate, payments, payments_per_year=12):
+    """Exact payment that pays off a mortgage in a number of payments
+
+    Args:
+        principal (float or array): Total mortgage
+        annual_interest_rate (float or array): Annual interest (between 0 and 1)
+        payments (int or array): Number of payments to pay it off in
+        payments_per_year (int or array): Payments (months) per year (default: 12)
+
+    Returns:
+        float or array: The payment, not rounded
+    """
+    r = np.asarray(annual_interest_rate, dtype=np.float64) / payments_per_year
+    n = np.asarray(payments, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(r > 0, principal * r / -np.expm1(-n * np.log1p(r)), principal / n)
+
+def payment_for_payoff(principal, annual_interest_rate, payments, payments_per_year=12):
+    """Payment needed to pay off a mortgage in a number of payments
+
+    Args:
+        principal (float or array): Total mortgage
+        annual_interest_rate (float or array): Annual interest (between 0 and 1)
+        payments (int or array): Number of payments to pay it off in
+        payments_per_year (int or array): Payments (months) per year (default: 12)
+
+    Returns:
+        float or array: The payment, rounded up to the cent so it's paid off in time
+    """
+    payment = np.ceil(np.round(annuity_payment(principal, annual_interest_rate, payments, payments_per_year) * 100, 6)) / 100
+    return float(payment) if np.ndim(payment) == 0 else payment
+
+def payoff_counts(principal, annual_interest_rate, target_payments, payments_per_year=12):
+    """Number of payments needed for each of many target payments
+
+    Unlike remaining_payments, payments too small to ever pay off the
+    mortgage get a count of -1 instead of raising an error.
+
+    Args:
+        principal (float or array): Total mortgage
+        annual_interest_rate (float or array): Annual interest (between 0 and 1)
+        target_payments (array): The payments to try
+        payments_per_year (int or array): Payments (months) per year (default: 12)
+
+    Returns:
+        array: The number of payments for each target payment
+    """
+    principal, rate, payments, per_year = np.broadcast_arrays(
+        np.asarray(principal, dtype=np.float64), np.asarray(annual_interest_rate, dtype=np.float64),
+        np.asarray(target_payments, dtype=np.float64), np.asarray(payments_per_year))
+    enough = payments > np.maximum(principal, 0) * rate / per_year
+    counts = np.full(payments.shape, -1, dtype=np.int64)
+    counts[enough] = remaining_payments(principal[enough], rate[enough], payments[enough], per_year[enough])
+    return counts
+
+@functools.lru_cache(maxsize=SOLVER_CACHE_SIZE)
+def solve_payment(principal, annual_interest_rate, term=30, payments_per_year=12):
+    """Cached payment_for_payoff for a term in years, for repeated what-if questions
+
+    Args:
+        principal (float): Total mortgage
+        annual_interest_rate (float): Annual interest (between 0 and 1)
+        term (float): Number of years to pay it off in (default: 30)
+        payments_per_year (int): Payments (months) per year (default: 12)
+
+    Returns:
+        float: The payment, rounded up to the cent
+    """
+    return payment_for_payoff(principal, annual_interest_rate, round(term * payments_per_year), payments_per_year)
+
+@functools.lru_cache(maxsize=SOLVER_CACHE_SIZE)
+def payoff_sweep(principal, annual_interest_rate, low, high, step, payments_per_year=12):
+    """Cached payoff_counts over an evenly spaced range of payments, for slider-driven sweeps
+
+    Args:
+        principal (float): Total mortgage
+        annual_interest_rate (float): Annual interest (between 0 and 1)
+        low, high (float): Smallest and largest payment to try
+        step (float): Spacing of the payments
+        payments_per_year (int): Payments (months) per year (default: 12)
+
+    Returns:
+        tuple: Read-only arrays of the payments tried and their payoff counts
+    """
+    payments = low + step * np.arange(int(math.floor((high - low) / step + 1e-9)) + 1)
+    counts = payoff_counts(principal, annual_interest_rate, payments, payments_per_year)
+    payments.flags.writeable = False
+    counts.flags.writeable = False
+    return payments, counts
+
+def total_interest(principal, annual_interest_rate, target_payment, payments, payments_per_year=12):
+    """Interest paid over the life of a mortgage
+
+    Args:
+        principal (float or array): Total mortgage
+        annual_interest_rate (float or array): Annual interest (between 0 and 1)
+        target_payment (float or array): How much is paid per payment
+        payments (int or array): Number of payments, from remaining_payments
+        payments_per_year (int or array): Payments (months) per year (default: 12)
+
+    Returns:
+        float or array: Total paid minus the principal; the last payment only covers what was left
+    """
+    r = np.asarray(annual_interest_rate, dtype=np.float64) / payments_per_year
+    last = balance_after(principal, annual_interest_rate, target_payment, payments - 1, payments_per_year) * (1 + r)
+    return np.where(payments > 0, (payments - 1) * np.asarray(target_payment) + last - principal, 0.0)
+
+def loan_results(columns):
+    """Minimum payment, payoff count and total interest for a chunk of loans
+
+    Args:
+        columns (dict): Each name in LOAN_COLUMNS mapped to a float array;
+            NaN target payments mean the minimum payment
+
+    Returns:
+        dict: Each name in RESULT_COLUMNS mapped to an array. Loans with
+            invalid values or a target below the minimum get a payments
+            count of -1 and NaN total interest, and status says why.
+    """
+    principal, rate, term, per_year, target = (columns[name] for name in LOAN_COLUMNS)
+    with np.errstate(invalid='ignore'):
+        valid = ((principal > 0) & (rate >= 0) & (rate <= 1) & (term > 0) & (per_year > 0)
+                 & (np.isnan(target) | (target > 0)) & np.isfinite(principal + rate + term + per_year))
+    valid &= (per_year == np.round(per_year)) & (term == np.round(term))
+
+    minimum = np.full(len(principal), np.nan)
+    minimum[valid] = min_payments(principal[valid], rate[valid], term[valid], per_year[valid])
+    target = np.where(np.isnan(target), minimum, target)
+    with np.errstate(invalid='ignore'):
+        ok = valid & (target >= minimum)
+
+    payments = np.full(len(principal), -1, dtype=np.int64)
+    interest = np.full(len(principal), np.nan)
+    payments[ok] = remaining_payments(principal[ok], rate[ok], target[ok], per_year[ok])
+    interest[ok] = total_interest(principal[ok], rate[ok], target[ok], payments[ok], per_year[ok])
+    status = np.where(ok, "ok", np.where(valid, "target below minimum", "invalid"))
+    return {"min_payment": minimum, "payments": payments, "total_interest": interest, "status": status}
+
+def to_float(text):
+    """Parse a number from a batch file; blanks and junk become NaN"""
+    try:
+        return float(text)
+    except ValueError:
+        return math.nan
+
+def csv_columns(header, lines):
+    """Parse lines of a CSV batch file into loan columns
+
+    Args:
+        header (list of str): Column names from the file's first line
+        lines (list of str): Lines of the file, without the header
+
+    Returns:
+        dict: Each name in LOAN_COLUMNS mapped to a float array
+    """
+    rows = list(csv.reader(lines))
+    columns = {}
+    for name in LOAN_COLUMNS:
+        if name in header:
+            i = header.index(name)
+            values = [to_float(row[i]) if len(row) > i and row[i].strip() else LOAN_DEFAULTS.get(name, math.nan)
+                      for row in rows]
+        else:
+            values = [LOAN_DEFAULTS.get(name, math.nan)] * len(rows)
+        columns[name] = np.array(values, dtype=np.float64)
+    return columns
+
+def process_chunk(chunk, output_format):
+    """Work out the results for one chunk of a batch file; run in a worker process
+
+    Args:
+        chunk (tuple): ("csv", header, lines) or ("columns", dict of loan columns)
+        output_format (str): "csv" to return CSV text, or "columns"
+
+    Returns:
+        str or dict: The loans and their results, as CSV lines or as columns
+    """
+    columns = csv_columns(*chunk[1:]) if chunk[0] == "csv" else chunk[1]
+    columns = dict(columns, **loan_results(columns))
+    if output_format == "columns":
+        return columns
+
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator="\n")
+    for row in zip(*(columns[name].tolist() for name in LOAN_COLUMNS + RESULT_COLUMNS)):
+        writer.writerow(["" if isinstance(value, float) and math.isnan(value) else
+                         int(value) if isinstance(value, float) and value.is_integer() else value
+                         for value in row])
+    return out.getvalue()
+
+def import_pyarrow():
+    """Import pyarrow, which is only needed for Parquet files
+
+    Raises:
+        ValueError: pyarrow isn't installed
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ValueError("reading or writing Parquet files requires pyarrow") from None
+    return pyarrow
+
+def read_chunks(filename, chunk_rows):
+    """Read a CSV or Parquet batch file a chunk at a time
+
+    Args:
+        filename (str): The batch file; names ending in .parquet are read as Parquet
+        chunk_rows (int): Loans per chunk
+
+    Yields:
+        tuple: Chunks for process_chunk
+    """
+    if filename.endswith(".parquet"):
+        pa = import_pyarrow()
+        parquet = pa.parquet.ParquetFile(filename)
+        names = [name for name in LOAN_COLUMNS if name in parquet.schema_arrow.names]
+        for batch in parquet.iter_batches(batch_size=chunk_rows, columns=names):
+            columns = {}
+            for name in LOAN_COLUMNS:
+                if name in names:
+                    values = batch.column(name).to_numpy(zero_copy_only=False).astype(np.float64)
+                    if name in LOAN_DEFAULTS:
+                        values[np.isnan(values)] = LOAN_DEFAULTS[name]
+                else:
+                    values = np.full(batch.num_rows, LOAN_DEFAULTS.get(name, math.nan))
+                columns[name] = values
+            yield ("columns", columns)
+    else:
+        with open(filename, 'r', newline='') as file:
+            header = [name.strip() for name in next(csv.reader([file.readline()]), [])]
+            while True:
+                lines = list(itertools.islice(file, chunk_rows))
+                if not lines:
+                    break
+                yield ("csv", header, lines)
+
+def run_batch(input_file, output_file, chunk_rows=BATCH_ROWS, processes=None):
+    """Work out the minimum payment, payoff count and total interest for every loan in a file
+
+    The input is read and the output written a chunk at a time, and the
+    chunks are worked on in a pool of processes. Only a few chunks per
+    process are held in memory at once, so memory use doesn't grow with
+    the size of the file.
+
+    Args:
+        input_file (str): CSV or Parquet file with LOAN_COLUMNS; only principal
+            and annual_interest_rate are required
+        output_file (str): Where to write the loans with RESULT_COLUMNS added;
+            names ending in .parquet are written as Parquet, others as CSV
+        chunk_rows (int): Loans per chunk (default: BATCH_ROWS)
+        processes (int): Number of worker processes (default: one per CPU)
+
+    Raises:
+        ValueError: The input file can't be read, or a Parquet file was given
+            but pyarrow isn't installed
+    """
+    output_format = "columns" if output_file.endswith(".parquet") else "csv"
+    pa = import_pyarrow() if output_format == "columns" else None
+    processes = processes or os.cpu_count() or 1
+    # read the first chunk before the output file is created, so a bad input leaves it alone
+    chunks = read_chunks(input_file, chunk_rows)
+    try:
+        first = list(itertools.islice(chunks, 1))
+    except OSError as e:
+        raise ValueError(f"could not read {input_file}: {e.strerror or e}") from None
+    chunks = itertools.chain(first, chunks)
+    writer = None
+
+    with open(output_file, 'wb') as out, ProcessPoolExecutor(processes) as pool:
+        if output_format == "csv":
+            out.write((",".join(LOAN_COLUMNS + RESULT_COLUMNS) + "\n").encode('utf-8'))
+        pending = deque(pool.submit(process_chunk, chunk, output_format)
+                        for chunk in itertools.islice(chunks, 2 * processes))
+        while pending:
+            result = pending.popleft().result()
+            for chunk in itertools.islice(chunks, 1):
+                pending.append(pool.submit(process_chunk, chunk, output_format))
+            if output_format == "csv":
+                out.write(result.encode('utf-8'))
+                continue
+            table = pa.table({name: result[name] for name in LOAN_COLUMNS + RESULT_COLUMNS})
+            if writer is None:
+                writer = pa.parquet.ParquetWriter(out, table.schema)
+            writer.write_table(table)
+        if writer is None and output_format == "columns":
+            # no loans: still write a valid file, with the same schema
+            empty = process_chunk(("columns", {name: np.empty(0) for name in LOAN_COLUMNS}), "columns")
+            writer = pa.parquet.ParquetWriter(out, pa.table({name: empty[name] for name in LOAN_COLUMNS + RESULT_COLUMNS}).schema)
+        if writer is not None:
+            writer.close()
+
+def simulate_loan(principal, annual_interest_rate, target_payment, term=30, payments_per_year=12,
+                  paths=1000, extra_chance=0.0, extra_mean=0.0, reset_every=0, rate_volatility=0.0,
+                  rate_floor=0.0, rate_cap=1.0, rng=None):
+    """Simulate many random paths of one mortgage
+
+    Each period, a path may make an extra payment (with probability
+    extra_chance, of an exponentially distributed size averaging
+    extra_mean). For an adjustable rate, every reset_every periods the
+    rate moves by a normal shock and is kept between rate_floor and
+    rate_cap; the payment then rises if needed to pay off the rest of the
+    balance in the remaining term. All paths are stepped together, one
+    period at a time, as arrays.
+
+    Args:
+        principal (float): Total mortgage
+        annual_interest_rate (float): Starting annual interest (between 0 and 1)
+        target_payment (float): Regular payment; for a fixed rate, at least the
+            payment that pays it off in the term, and always more than the
+            first period's interest
+        term (int): Number of years for mortgage (default: 30)
+        payments_per_year (int): Payments (months) per year (default: 12)
+        paths (int): Number of paths to simulate (default: 1000)
+        extra_chance (float): Chance of an extra payment each period (default: 0)
+        extra_mean (float): Average size of an extra payment (default: 0)
+        reset_every (int): Periods between rate resets, or 0 for a fixed rate (default: 0)
+        rate_volatility (float): Standard deviation of each rate shock (default: 0)
+        rate_floor (float): Lowest rate after a reset (default: 0)
+        rate_cap (float): Highest rate after a reset (default: 1)
+        rng (numpy.random.Generator): Source of randomness (default: a fresh, unseeded one)
+
+    Returns:
+        tuple: Two arrays with one entry per path: the number of payments
+            until payoff (-1 for a path that still owes money at the end of
+            the term), and the total interest paid
+
+    Raises:
+        ValueError: The target payment is too small to ever pay off the mortgage
+    """
+    rng = np.random.default_rng(rng)
+    periods = term * payments_per_year
+    if target_payment <= interest_due(principal, annual_interest_rate, payments_per_year):
+        raise ValueError("target payment does not cover the interest")
+    if not reset_every and target_payment < annuity_payment(principal, annual_interest_rate, periods, payments_per_year):
+        raise ValueError("target payment is less than the minimum payment")
+    extra = np.zeros((periods, paths))
+    if extra_chance > 0 and extra_mean > 0:
+        extra = np.where(rng.random((periods, paths)) < extra_chance,
+                         rng.exponential(extra_mean, (periods, paths)), 0.0)
+    resets = reset_every and periods // reset_every
+    shocks = rng.normal(0.0, rate_volatility, (resets, paths)) if resets else None
+
+    balance = np.full(paths, float(principal))
+    rate = np.full(paths, annual_interest_rate / payments_per_year)
+    payment = np.full(paths, float(target_payment))
+    interest_paid = np.zeros(paths)
+    payoff = np.full(paths, -1)
+    for period in range(periods):
+        if reset_every and period and period % reset_every == 0:
+            annual = np.clip(rate * payments_per_year + shocks[period // reset_every - 1], rate_floor, rate_cap)
+            rate = annual / payments_per_year
+            left = periods - period
+            with np.errstate(divide='ignore', invalid='ignore'):
+                needed = np.where(rate > 0, balance * rate / -np.expm1(-left * np.log1p(rate)), balance / left)
+            payment = np.maximum(payment, needed)
+        interest = balance * rate
+        paid = np.minimum(payment + extra[period], balance + interest)
+        balance += interest - paid
+        interest_paid += interest
+        finished = (balance <= 1e-9) & (payoff == -1)
+        payoff[finished] = period + 1
+        balance[balance <= 1e-9] = 0.0
+        if not balance.any():
+            break
+    return payoff, interest_paid
+
+def summarize(values, percentiles=PERCENTILES):
+    """Percentiles of simulated results
+
+    Args:
+        values (array): One result per path
+        percentiles (sequence of float): Which percentiles to report (default: PERCENTILES)
+
+    Returns:
+        dict: Each percentile mapped to its value, plus "mean"; all NaN if there are no values
+    """
+    if len(values) == 0:
+        return dict.fromkeys([*percentiles, "mean"], math.nan)
+    summary = dict(zip(percentiles, np.percentile(values, percentiles).tolist()))
+    summary["mean"] = float(np.mean(values))
+    return summary
+
+def simulate_summary(loan, scenario, seed, percentiles):
+    """Simulate one loan and summarize it; run in a worker process by simulate_portfolio
+
+    Only paths that pay the loan off within its term are summarized;
+    "unpaid" is the share of paths that don't.
+    """
+    payoff, interest = simulate_loan(**loan, **scenario, rng=np.random.default_rng(seed))
+    paid = payoff >= 0
+    return {"payments": summarize(payoff[paid], percentiles),
+            "total_interest": summarize(interest[paid], percentiles),
+            "unpaid": float(1 - paid.mean())}
+
+def simulate_portfolio(loans, seed=None, processes=None, percentiles=PERCENTILES, **scenario):
+    """Simulate many loans across a pool of processes
+
+    Every loan gets its own random stream spawned from seed, so the
+    results don't depend on how many processes are used.
+
+    Args:
+        loans (list of dict): Keyword arguments of simulate_loan for each loan
+            (principal, annual_interest_rate, target_payment, and optionally
+            term and payments_per_year)
+        seed (int): Seed for all the random streams (default: unseeded)
+        processes (int): Number of worker processes (default: one per CPU)
+        percentiles (sequence of float): Which percentiles to report (default: PERCENTILES)
+        scenario: Other keyword arguments of simulate_loan, shared by every loan
+
+    Returns:
+        list of dict: For each loan, summaries of "payments" and "total_interest"
+            over the paths that pay it off, and the "unpaid" share of paths
+    """
+    seeds = np.random.SeedSequence(seed).spawn(len(loans))
+    processes = processes or os.cpu_count() or 1
+    chunksize = max(1, len(loans) // (8 * processes))
+    with ProcessPoolExecutor(processes) as pool:
+        return list(pool.map(simulate_summary, loans, itertools.repeat(scenario), seeds,
+                             itertools.repeat(percentiles), chunksize=chunksize))
+
+def main(principal, annual_interest_rate, term=30, payments_per_year=12, target_payment=None):
+    """Main function to calculate and display results
+
+    Args:
+        principal (float): Total mortgage
+        annual_interest_rate (float): Annual interest (between 0 and 1)
+        term (int): Number of years for mortgage (default: 30)
+        payments_per_year (int): Payments (months) per year (default: 12)
+        target_payment (float): How much user wants to pay per payment (default: None)
+    """
+    min_payment = get_min_payment(principal, annual_interest_rate, term, payments_per_year)
+    print(f"Minimum payment: ${min_payment}")
+
+    if target_payment is None:
+        target_payment = min_payment
+
+    if target_payment < min_payment:
+        print("Target payment is less than minimum payment")
+    else:
+        total_payments = remaining_payments(principal, annual_interest_rate, target_payment, payments_per_year)
+        print(f"With payments of ${target_payment}, the mortgage will be paid in {total_payments} payments.")
+
+def parse_args(arglist):
+    """Parse and validate command-line arguments.
+
+    Args:
+        arglist (list of str): List of command-line arguments.
+
+    Returns:
+        namespace: The parsed arguments (see argparse documentation for more information).
+
+    Raises:
+        ValueError: Encountered an invalid argument.
+    """
+    parser = ArgumentParser()
+    parser.add_argument("mortgage_amount", type=float, nargs="?", help="the total amount of the mortgage")
+    parser.add_argument("annual_interest_rate", type=float, nargs="?", help="the annual interest rate, as a float between 0 and 1")
+    parser.add_argument("-y", "--years", type=int, default=30, help="the term of the mortgage in years (default: 30)")
+    parser.add_argument("-n", "--num_annual_payments", type=int, default=12, help="the number of payments per year (default: 12)")
+    parser.add_argument("-p", "--target_payment", type=float, help="the amount you want to pay per payment (default: the minimum payment)")
+    parser.add_argument("--batch", nargs=2, metavar=("INPUT", "OUTPUT"), help="work out results for every loan in a CSV or Parquet file of " + ", ".join(LOAN_COLUMNS) + " and write them to OUTPUT")
+    parser.add_argument("--processes", type=int, help="number of worker processes for --batch (default: one per CPU)")
+    
+    args = parser.parse_args(arglist)
+    if args.batch:
+        return args
+    if args.mortgage_amount is None or args.annual_interest_rate is None:
+        raise ValueError("mortgage amount and annual interest rate are required")
+    if args.mortgage_amount <= 0:
+        raise ValueError("mortgage amount must be positive")
+    if not 0 <= args.annual_interest_rate <= 1:
+        raise ValueError("annual interest rate must be between 0 and 1")
+    if args.years <= 0:
+        raise ValueError("years must be positive")
+    if args.num_annual_payments <= 0:
+        raise ValueError("number of payments per year must be positive")
+    if args.target_payment is not None and args.target_payment <= 0:
+        raise ValueError("target payment must be positive")
+
+    return args
+
+if __name__ == "__main__":
+    try:
+        args = parse_args(sys.argv[1:])
+    except ValueError as e:
+        sys.exit(str(e))
+    if args.batch:
+        try:
+            run_batch(*args.batch, processes=args.processes)
+        except ValueError as e:
+            sys.exit(str(e))
+    else:
+        main(args.mortgage_amount, args.annual_interest_rate, args.years, args.num_annual_payments, args.target_payment)
@@ -1,33 +1,684 @@
 from argparse import ArgumentParser
+from array import array
+import bisect
+from collections.abc import Mapping, Sequence
+import heapq
+import io
+import math
+import mmap
+import os
+import socketserver
+import stat
+import struct
 import sys
 from haversine import haversine
+import numpy as np
+
+# Mean earth radius in km, the same value haversine uses
+EARTH_RADIUS_KM = 6371.0088
+
+# Upper bound on the scratch memory one chunk of nearest_many may use
+CHUNK_BYTES = 64 * 1024 * 1024
+
+# Compiled copy of a city file, written next to it the first time it's read
+CACHE_SUFFIX = ".cache"
+CACHE_MAGIC = b"CITIES03"
+# magic, number of cities, number of areas, area and city name bytes,
+# and the size and mtime (ns) of the source file it was built from
+CACHE_HEADER = struct.Struct("<8sqqqqqq")
+
+# Size in degrees of the grid cells used by Cities.within and Cities.box
+GRID_DEGREES = 1.0
+GRID_ROWS = int(math.ceil(180 / GRID_DEGREES))
+GRID_COLS = int(math.ceil(360 / GRID_DEGREES))
+
+def to_xyz(lat, lon):
+    """ Convert a latitude and longitude to a point on the unit sphere
+
+    Straight-line (chord) distance between two of these points grows with
+    the great-circle distance, so the closest points in 3D are also the
+    closest cities by haversine.
+
+    Args:
+    lat (float): Latitude in decimal degrees
+    lon (float): Longitude in decimal degrees
+
+    Returns:
+    tuple: x, y and z coordinates as floats """
+
+    lat = math.radians(lat)
+    lon = math.radians(lon)
+    return (math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat))
+
+class KDTree:
+    """ A static k-d tree over 3D points, stored as flat arrays
+
+    The tree is implicit: for the slice of positions lo to hi, the node is
+    at the middle position, the left subtree is the slice before it and
+    the right subtree is the slice after it.
+
+    Attributes:
+    points (array): x, y, z of every point, in tree order
+    ids (array): Original index of the point at each tree position
+    axes (array): Splitting axis (0, 1 or 2) of the node at each tree position """
+
+    def __init__(self, points):
+        """ Build the tree
+
+        Args:
+        points (array-like): x, y and z of each point, shape (n, 3) """
+
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        order = np.arange(len(points))
+        self.axes = array('b', bytes(len(points)))
+        self._build(points, order, 0, len(points))
+        self.ids = array('q', order.tobytes())
+        self.points = array('d', points[order].tobytes())
+
+    @classmethod
+    def from_arrays(cls, points, ids, axes):
+        """ Wrap arrays saved from another tree without rebuilding it
+
+        Args:
+        points, ids, axes: Sequences laid out like the attributes of the same name
+
+        Returns:
+        KDTree: The tree """
+
+        tree = cls.__new__(cls)
+        tree.points = points
+        tree.ids = ids
+        tree.axes = axes
+        return tree
+
+    def _build(self, points, order, lo, hi):
+        """ Arrange order[lo:hi] into a subtree, splitting at the median of the widest axis """
+        if hi - lo <= 1:
+            return
+        if hi - lo <= 64:
+            # NumPy's per-call overhead dominates on small slices
+            ids = order[lo:hi].tolist()
+            self._build_small(dict(zip(ids, points[ids].tolist())), ids, 0, hi - lo, lo)
+            order[lo:hi] = ids
+            return
+        block = points[order[lo:hi]]
+        axis = int(np.argmax(block.max(axis=0) - block.min(axis=0)))
+        mid = (lo + hi) // 2
+        order[lo:hi] = order[lo:hi][np.argpartition(block[:, axis], mid - lo)]
+        self.axes[mid] = axis
+        self._build(points, order, lo, mid)
+        self._build(points, order, mid + 1, hi)
+
+    def _build_small(self, points, ids, lo, hi, base):
+        """ The same as _build, in plain Python, for a slice starting at position base """
+        if hi - lo <= 1:
+            return
+        spans = []
+        for axis in range(3):
+            values = [points[i][axis] for i in ids[lo:hi]]
+            spans.append(max(values) - min(values))
+        axis = spans.index(max(spans))
+        ids[lo:hi] = sorted(ids[lo:hi], key=lambda i: points[i][axis])
+        mid = (lo + hi) // 2
+        self.axes[base + mid] = axis
+        self._build_small(points, ids, lo, mid, base)
+        self._build_small(points, ids, mid + 1, hi, base)
+
+    def query(self, point, k):
+        """ Find the k points closest to a point
+
+        Args:
+        point (tuple): x, y and z of the query point
+        k (int): How many points to return
+
+        Returns:
+        list: Original indexes of the closest points, closest first """
+
+        if k <= 0:
+            return []
+        best = []
+        self._search(point, k, best, 0, len(self.ids))
+        return [self.ids[pos] for dist, pos in sorted((-d, pos) for d, pos in best)]
+
+    def _search(self, point, k, best, lo, hi):
+        """ Walk the subtree for positions lo to hi, keeping the k best in a max-heap """
+        if lo >= hi:
+            return
+        mid = (lo + hi) // 2
+        base = 3 * mid
+        dist = ((self.points[base] - point[0]) ** 2 + (self.points[base + 1] - point[1]) ** 2
+                + (self.points[base + 2] - point[2]) ** 2)
+        if len(best) < k:
+            heapq.heappush(best, (-dist, mid))
+        elif dist < -best[0][0]:
+            heapq.heapreplace(best, (-dist, mid))
+
+        axis = self.axes[mid]
+        diff = point[axis] - self.points[base + axis]
+        near, far = ((lo, mid), (mid + 1, hi)) if diff < 0 else ((mid + 1, hi), (lo, mid))
+        self._search(point, k, best, *near)
+        if len(best) < k or diff * diff < -best[0][0]:
+            self._search(point, k, best, *far)
+
+class CityNames(Sequence):
+    """ The (area, city) names of a compiled city file, decoded on demand
+
+    Area names are interned: each is stored once and cities refer to it by
+    number. City names are one UTF-8 blob with an offset per city. """
+
+    def __init__(self, areas, area_ids, offsets, blob):
+        """ Set up the name table
+
+        Args:
+        areas (list): Distinct area names
+        area_ids (sequence): Position in areas of each city's area
+        offsets (sequence): Start of each city's name in blob, plus the end of the last
+        blob (memoryview): UTF-8 city names, back to back """
+
+        self.areas = areas
+        self.area_ids = area_ids
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.area_ids)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("city index out of range")
+        city = bytes(self.blob[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+        return (self.areas[self.area_ids[i]], city)
+
+class CityTable(Mapping):
+    """ Read-only mapping of (area, city) to (latitude, longitude)
+
+    Works like the dict Cities used to build, but sits on top of the
+    compiled arrays. A city is looked up by name with a binary search over
+    the rows in name order, which is stored in the compiled file. """
+
+    def __init__(self, names, lat, lon, order):
+        """ Set up the table
+
+        Args:
+        names (CityNames): Name of each city
+        lat, lon (sequence): Latitude and longitude of each city in degrees
+        order (sequence): Row numbers sorted by (area, city) name """
+
+        self.names = names
+        self.lat = lat
+        self.lon = lon
+        self.order = order
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __getitem__(self, key):
+        try:
+            pos = bisect.bisect_left(self.order, key, key=lambda i: self.names[i])
+        except TypeError:
+            raise KeyError(key) from None
+        if pos == len(self.order) or self.names[self.order[pos]] != key:
+            raise KeyError(key)
+        return self.point(self.order[pos])
+
+    def point(self, i):
+        """ Latitude and longitude of the city in row i """
+        return (self.lat[i], self.lon[i])
+
+def grid_cells(lat, lon):
+    """ Grid cell of each point, numbered row by row from the south pole and 180 degrees west
+
+    Args:
+    lat, lon (array-like): Latitudes and longitudes in decimal degrees
+
+    Returns:
+    ndarray: Cell number of each point """
+
+    rows = np.clip(np.floor((np.asarray(lat) + 90) / GRID_DEGREES), 0, GRID_ROWS - 1)
+    cols = np.floor((np.asarray(lon) + 180) / GRID_DEGREES) % GRID_COLS
+    return (rows * GRID_COLS + cols).astype(np.int64)
+
+def cache_layout(count, areas, area_bytes, city_bytes):
+    """ The arrays of a compiled city file, in the order they're stored
+
+    Args:
+    count (int): Number of cities
+    areas (int): Number of distinct areas
+    area_bytes (int): Size of the area name blob
+    city_bytes (int): Size of the city name blob
+
+    Returns:
+    list: (name, typecode, length) for each array """
+
+    return [("lat", 'd', count), ("lon", 'd', count),
+            ("lat_rad", 'd', count), ("lon_rad", 'd', count), ("cos_lat", 'd', count),
+            ("points", 'd', 3 * count), ("ids", 'q', count), ("axes", 'b', count),
+            ("grid_ids", 'q', count), ("grid_starts", 'q', GRID_ROWS * GRID_COLS + 1),
+            ("area_ids", 'i', count), ("area_offsets", 'q', areas + 1),
+            ("city_offsets", 'q', count + 1), ("name_order", 'q', count),
+            ("area_blob", 'B', area_bytes), ("city_blob", 'B', city_bytes)]
+
+def cache_size(count, areas, area_bytes, city_bytes):
+    """ Size in bytes of a compiled city file, header and padding included
+
+    Args:
+    count, areas, area_bytes, city_bytes (int): As for cache_layout
+
+    Returns:
+    int: The size """
+
+    size = CACHE_HEADER.size
+    for name, typecode, length in cache_layout(count, areas, area_bytes, city_bytes):
+        size += -size % 8 + length * struct.calcsize(typecode)
+    return size
+
+def compile_cities(filename):
+    """ Parse a city file into the compiled format
+
+    Args:
+    filename (string): City data, 4 values per line: State/country, city, latitude, and longitude
+
+    Returns:
+    bytes: The compiled file, header included """
+
+    stat = os.stat(filename)
+    cities = {}
+    with open(filename, 'r') as file:
+        for line in file:
+            area, city, lat, lon = line.strip().split(',')
+            cities[(area, city)] = (float(lat), float(lon))
+    names = list(cities)
+
+    coords = np.array(list(cities.values()), dtype=np.float64).reshape(-1, 2)
+    lat_rad = np.radians(coords[:, 0])
+    lon_rad = np.radians(coords[:, 1])
+    cos_lat = np.cos(lat_rad)
+    # the same points as to_xyz, for every city at once
+    tree = KDTree(np.column_stack((cos_lat * np.cos(lon_rad), cos_lat * np.sin(lon_rad), np.sin(lat_rad))))
+
+    # cities sorted by grid cell, and where each cell starts in that order
+    cells = grid_cells(coords[:, 0], coords[:, 1])
+    grid_ids = np.argsort(cells, kind='stable')
+    grid_starts = np.searchsorted(cells[grid_ids], np.arange(GRID_ROWS * GRID_COLS + 1))
+
+    areas = {}
+    area_ids = array('i', [areas.setdefault(area, len(areas)) for area, city in names])
+    area_names = [area.encode('utf-8') for area in areas]
+    city_names = [city.encode('utf-8') for area, city in names]
+    arrays = {
+        "lat": np.ascontiguousarray(coords[:, 0]), "lon": np.ascontiguousarray(coords[:, 1]),
+        "lat_rad": lat_rad, "lon_rad": lon_rad, "cos_lat": cos_lat,
+        "points": tree.points, "ids": tree.ids, "axes": tree.axes,
+        "grid_ids": grid_ids.astype(np.int64), "grid_starts": grid_starts.astype(np.int64),
+        "area_ids": area_ids,
+        "area_offsets": array('q', [0] + [len(n) for n in area_names]),
+        "city_offsets": array('q', [0] + [len(n) for n in city_names]),
+        "name_order": array('q', sorted(range(len(names)), key=names.__getitem__)),
+        "area_blob": b"".join(area_names), "city_blob": b"".join(city_names)}
+    for name in ("area_offsets", "city_offsets"):
+        offsets = arrays[name]
+        for i in range(1, len(offsets)):
+            offsets[i] += offsets[i - 1]
+
+    header = CACHE_HEADER.pack(CACHE_MAGIC, len(names), len(areas),
+                               len(arrays["area_blob"]), len(arrays["city_blob"]),
+                               stat.st_size, stat.st_mtime_ns)
+    parts = [header]
+    size = len(header)
+    for name, typecode, length in cache_layout(len(names), len(areas),
+                                               len(arrays["area_blob"]), len(arrays["city_blob"])):
+        data = memoryview(arrays[name]).cast('B').tobytes()
+        padding = -size % 8
+        parts.append(bytes(padding) + data)
+        size += padding + len(data)
+    return b"".join(parts)
 
 class Cities:
-    def __init__(self, filename):
+    def __init__(self, filename, cache=True):
         
         """ Create the Cities class and take in city data from files
 
+        The file is compiled into a binary cache (filename + CACHE_SUFFIX)
+        holding the coordinates, the names and the search index. Later runs
+        map the cache into memory instead of parsing the file again, as
+        long as the file's size and modification time haven't changed.
+
+        Args:
+        filename (string): Getting the city data. 4 values: State/country, city, latitude, and longitude
+        cache (bool): Whether to read and write the compiled cache (default: True) """
+
+        cache_file = filename + CACHE_SUFFIX
+        buffer = self.open_cache(filename, cache_file) if cache else None
+        if buffer is None:
+            buffer = compile_cities(filename)
+            if cache:
+                try:
+                    temp_file = f"{cache_file}.{os.getpid()}.tmp"
+                    with open(temp_file, 'wb') as file:
+                        file.write(buffer)
+                    os.replace(temp_file, cache_file)
+                except OSError:
+                    pass
+        self.load(buffer)
+
+    def open_cache(self, filename, cache_file):
+        """ Map the compiled cache into memory, if it's still up to date
+
+        Args:
+        filename (string): The city file
+        cache_file (string): Its compiled cache
+
+        Returns:
+        mmap: The cache, or None if it's missing, stale or the wrong size """
+
+        try:
+            stat = os.stat(filename)
+            with open(cache_file, 'rb') as file:
+                buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        if len(buffer) < CACHE_HEADER.size:
+            return None
+        magic, *counts, size, mtime = CACHE_HEADER.unpack_from(buffer)
+        if magic != CACHE_MAGIC or (size, mtime) != (stat.st_size, stat.st_mtime_ns):
+            return None
+        # a cut short or padded out cache would put the arrays in the wrong place
+        if min(counts) < 0 or len(buffer) != cache_size(*counts):
+            return None
+        return buffer
+
+    def load(self, buffer):
+        """ Point the attributes at the arrays in a compiled city file, without copying
+
         Args:
-        filename (string): Getting the city data. 4 values: State/country, city, latitude, and longitude """
+        buffer (bytes or mmap): The compiled file """
 
-        self.cities = {}
-        with open(filename, 'r') as file:
-            for line in file:
-                area, city, lat, lon = line.strip().split(',')
-                self.cities[(area, city)] = (float(lat), float(lon))
+        self.buffer = buffer
+        view = memoryview(buffer)
+        magic, count, areas, area_bytes, city_bytes, size, mtime = CACHE_HEADER.unpack_from(buffer)
+        arrays = {}
+        offset = CACHE_HEADER.size
+        for name, typecode, length in cache_layout(count, areas, area_bytes, city_bytes):
+            offset += -offset % 8
+            nbytes = length * struct.calcsize(typecode)
+            arrays[name] = view[offset:offset + nbytes].cast(typecode)
+            offset += nbytes
 
-    def nearest(self, point):
+        area_offsets, area_blob = arrays["area_offsets"], arrays["area_blob"]
+        area_names = [bytes(area_blob[area_offsets[i]:area_offsets[i + 1]]).decode('utf-8')
+                      for i in range(areas)]
+        self.names = CityNames(area_names, arrays["area_ids"], arrays["city_offsets"], arrays["city_blob"])
+        self.cities = CityTable(self.names, arrays["lat"], arrays["lon"], arrays["name_order"])
+        self.index = KDTree.from_arrays(arrays["points"], arrays["ids"], arrays["axes"])
+
+        self.grid_ids = np.frombuffer(arrays["grid_ids"], dtype=np.int64)
+        self.grid_starts = np.frombuffer(arrays["grid_starts"], dtype=np.int64)
+
+        self.lat_deg = np.frombuffer(arrays["lat"], dtype=np.float64)
+        self.lon_deg = np.frombuffer(arrays["lon"], dtype=np.float64)
+        self.lat = np.frombuffer(arrays["lat_rad"], dtype=np.float64)
+        self.lon = np.frombuffer(arrays["lon_rad"], dtype=np.float64)
+        self.cos_lat = np.frombuffer(arrays["cos_lat"], dtype=np.float64)
+
+    def nearest(self, point, k=5):
         """
-        To five the closest 5 cities from the chosen point on the coordinate map
+        To find the closest k cities from the chosen point on the coordinate map
 
         Args:
         point (tuple): Holding latitude and longitude as floats
+        k (int): How many cities to return (default: 5)
 
         Returns:
-        list: Listing out the five closest cities to the coordinate """
+        list: Listing out the k closest cities to the coordinate """
 
-        sorted_cities = sorted(self.cities.keys(), key=lambda x: haversine(point, self.cities[x]))
-        return sorted_cities[:5]
+        closest = self.index.query(to_xyz(*point), k)
+        closest.sort(key=lambda i: haversine(point, self.cities.point(i)))
+        return [self.names[i] for i in closest]
+
+    def nearest_many(self, points, k=5, chunk_size=None):
+        """
+        To find the closest k cities for many points at once
+
+        Distances are computed with NumPy, a chunk of points at a time, so
+        memory stays bounded no matter how many points are passed in.
+
+        Args:
+        points (array-like): Latitude and longitude pairs, shape (m, 2)
+        k (int): How many cities to return per point (default: 5)
+        chunk_size (int): Points per chunk (default: sized to fit CHUNK_BYTES)
+
+        Returns:
+        tuple: Two arrays of shape (m, k). The first holds indexes into
+               self.names, closest first; the second holds the distances in km """
+
+        points = np.radians(np.asarray(points, dtype=np.float64).reshape(-1, 2))
+        k = max(0, min(k, len(self.names)))
+        indexes = np.empty((len(points), k), dtype=np.int64)
+        distances = np.empty((len(points), k), dtype=np.float64)
+        if k == 0:
+            return indexes, distances
+        if chunk_size is None:
+            # at most two (chunk, cities) arrays of 8 byte values are alive at
+            # once: a with either its scratch array or argpartition's result.
+            # Count three so argpartition's own working space fits too
+            chunk_size = max(1, CHUNK_BYTES // (3 * 8 * len(self.names)))
+
+        for start in range(0, len(points), chunk_size):
+            lat = points[start:start + chunk_size, 0:1]
+            lon = points[start:start + chunk_size, 1:2]
+            # haversine without the final arcsin, which doesn't change the order,
+            # worked out in place so no other temporaries are made
+            a = np.subtract(self.lat, lat)
+            a /= 2
+            np.sin(a, out=a)
+            np.square(a, out=a)
+            scratch = np.subtract(self.lon, lon)
+            scratch /= 2
+            np.sin(scratch, out=scratch)
+            np.square(scratch, out=scratch)
+            scratch *= self.cos_lat
+            scratch *= np.cos(lat)
+            a += scratch
+            del scratch
+            if k < len(self.names):
+                # copied so the full (chunk, cities) result can be freed
+                top = np.argpartition(a, k - 1, axis=1)[:, :k].copy()
+            else:
+                top = np.broadcast_to(np.arange(k), a.shape).copy()
+            top_a = np.take_along_axis(a, top, axis=1)
+            order = np.argsort(top_a, axis=1, kind='stable')
+            indexes[start:start + chunk_size] = np.take_along_axis(top, order, axis=1)
+            top_a = np.take_along_axis(top_a, order, axis=1)
+            distances[start:start + chunk_size] = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(top_a, 0, 1)))
+        return indexes, distances
+
+    def grid_candidates(self, south, north, west, span):
+        """ Rows of every city in the grid cells overlapping a box
+
+        Args:
+        south, north (float): Latitude limits in decimal degrees
+        west (float): Western longitude limit in decimal degrees
+        span (float): Width of the box eastward from west, in degrees
+
+        Returns:
+        ndarray: Row numbers of the cities, a superset of those in the box """
+
+        first_row, last_row = grid_cells([south, north], [0, 0]) // GRID_COLS
+        first_col = int(math.floor((west + 180) / GRID_DEGREES))
+        last_col = int(math.floor((west + span + 180) / GRID_DEGREES))
+        if last_col - first_col + 1 >= GRID_COLS:
+            cols = range(GRID_COLS)
+        else:
+            cols = [col % GRID_COLS for col in range(first_col, last_col + 1)]
+
+        pieces = []
+        for row in range(first_row, last_row + 1):
+            for col in cols:
+                cell = row * GRID_COLS + col
+                start, end = self.grid_starts[cell], self.grid_starts[cell + 1]
+                if start < end:
+                    pieces.append(self.grid_ids[start:end])
+        return np.concatenate(pieces) if pieces else np.empty(0, dtype=np.int64)
+
+    def box(self, south, west, north, east):
+        """
+        To find every city inside a latitude/longitude box
+
+        A box whose west edge is east of its east edge wraps across the
+        180th meridian.
+
+        Args:
+        south, north (float): Latitude limits in decimal degrees
+        west, east (float): Longitude limits in decimal degrees
+
+        Returns:
+        list: The cities in the box, in file order """
+
+        if south > north:
+            return []
+        span = east - west
+        if span < 0:
+            span += 360
+        west = (west + 180) % 360 - 180
+        rows = self.grid_candidates(south, north, west, span)
+        lat = self.lat_deg[rows]
+        lon = self.lon_deg[rows]
+        inside = (lat >= south) & (lat <= north)
+        if span < 360:
+            inside &= (lon - west) % 360 <= span
+        return [self.names[i] for i in np.sort(rows[inside])]
+
+    def within(self, point, radius_km):
+        """
+        To find every city within a distance of the chosen point
+
+        Args:
+        point (tuple): Holding latitude and longitude as floats
+        radius_km (float): Distance from the point, in km
+
+        Returns:
+        list: The cities within radius_km of the point, closest first """
+
+        lat, lon = point
+        radius = radius_km / EARTH_RADIUS_KM
+        if radius < 0:
+            return []
+        south = max(-90.0, lat - math.degrees(radius))
+        north = min(90.0, lat + math.degrees(radius))
+        if south == -90 or north == 90 or radius >= math.pi / 2:
+            west, span = -180.0, 360.0
+        else:
+            # widest longitude difference a point within the radius can have
+            half_width = math.degrees(math.asin(min(1.0, math.sin(radius) / math.cos(math.radians(lat)))))
+            west, span = lon - half_width, 2 * half_width
+        rows = self.grid_candidates(south, north, (west + 180) % 360 - 180, span)
+
+        lat, lon = math.radians(lat), math.radians(lon)
+        a = np.sin((self.lat[rows] - lat) / 2) ** 2
+        a += math.cos(lat) * self.cos_lat[rows] * np.sin((self.lon[rows] - lon) / 2) ** 2
+        distances = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+        inside = distances <= radius_km
+        rows, distances = rows[inside], distances[inside]
+        return [self.names[i] for i in rows[np.lexsort((rows, distances))]]
+
+def answer(cities, query):
+    """
+    Answer one query for the server mode
+
+    Queries are one of:
+        nearest LAT LON [K]
+        within LAT LON RADIUS_KM
+        box SOUTH WEST NORTH EAST
+
+    Args:
+    cities (Cities): The loaded city data
+    query (str): The query line
+
+    Returns:
+    list of str: One line per city, or a single line starting with "error:" """
+
+    try:
+        command, *values = query.split()
+        if command == "nearest" and len(values) in (2, 3):
+            k = int(values[2]) if len(values) == 3 else 5
+            results = cities.nearest((finite(values[0]), finite(values[1])), k)
+        elif command == "within" and len(values) == 3:
+            results = cities.within((finite(values[0]), finite(values[1])), finite(values[2]))
+        elif command == "box" and len(values) == 4:
+            results = cities.box(*map(finite, values))
+        else:
+            return [f"error: could not understand {query.strip()!r}"]
+        return [", ".join(result) for result in results]
+    except ValueError as e:
+        return [f"error: {e}"]
+    except Exception as e:
+        # one bad query must not take the whole server down
+        return [f"error: {type(e).__name__}: {e}"]
+
+def finite(value):
+    """ Convert a query value to a float, rejecting nan and infinities with ValueError """
+    number = float(value)
+    if not math.isfinite(number):
+        raise ValueError(f"{value!r} is not a finite number")
+    return number
+
+def serve(cities, infile, outfile):
+    """
+    Answer queries, one per line, until the input ends
+
+    Each answer is followed by a blank line and flushed right away, so a
+    client can send the next query as soon as it sees the blank line.
+
+    Args:
+    cities (Cities): The loaded city data
+    infile (file): Where queries are read from
+    outfile (file): Where answers are written to """
+
+    for query in infile:
+        if not query.strip():
+            continue
+        for line in answer(cities, query):
+            outfile.write(line + "\n")
+        outfile.write("\n")
+        outfile.flush()
+
+def serve_socket(cities, path):
+    """
+    Answer queries from clients of a Unix domain socket, until interrupted
+
+    Each connection is handled like serve handles stdin and stdout.
+
+    Args:
+    cities (Cities): The loaded city data
+    path (str): Filename of the socket to create; a stale socket there is replaced
+
+    Raises:
+    ValueError: Something other than a socket already exists at path """
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            infile = io.TextIOWrapper(self.rfile, encoding='utf-8')
+            outfile = io.TextIOWrapper(self.wfile, encoding='utf-8')
+            serve(cities, infile, outfile)
+
+    if os.path.exists(path):
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            raise ValueError(f"Error: {path} already exists and is not a socket")
+        os.remove(path)
+    with socketserver.ThreadingUnixStreamServer(path, Handler) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(path)
 
 def main(filename, arg1, arg2):
     """
@@ -75,15 +726,33 @@ def parse_args(arglist):
     """
     parser = ArgumentParser()
     parser.add_argument("filename", help="file containing city data")
-    parser.add_argument("arg1",
+    parser.add_argument("arg1", nargs="?",
                         help="a latitude expressed in decimal degrees"
                              " or an area (state, country) from the"
                              " file")
-    parser.add_argument("arg2",
+    parser.add_argument("arg2", nargs="?",
                         help="a longitude expressed in decimal degrees"
                              " or a city name from the file")
-    return parser.parse_args(arglist)
+    parser.add_argument("--serve", action="store_true",
+                        help="load the file once, then answer queries from"
+                             " stdin (nearest LAT LON [K], within LAT LON"
+                             " RADIUS_KM, box SOUTH WEST NORTH EAST)")
+    parser.add_argument("--socket",
+                        help="like --serve, but answer clients of a Unix"
+                             " domain socket created at this path")
+    args = parser.parse_args(arglist)
+    if not (args.serve or args.socket) and args.arg2 is None:
+        parser.error("arg1 and arg2 are required unless --serve or --socket is given")
+    return args
 
 if __name__ == "__main__":
     args = parse_args(sys.argv[1:])
-    main(args.filename, args.arg1, args.arg2)  
+    if args.socket:
+        try:
+            serve_socket(Cities(args.filename), args.socket)
+        except ValueError as e:
+            sys.exit(str(e))
+    elif args.serve:
+        serve(Cities(args.filename), sys.stdin, sys.stdout)
+    else:
+        main(args.filename, args.arg1, args.arg2)
@@ -1,39 +1,222 @@
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import mmap
+import os
+import re
+import struct
+
+DASHES = re.compile(r"--+")
+WORD = re.compile(r"[\w'-]+")
+NON_WORD_CHAR = re.compile(r"[^\w'-]")
+# Characters read from a file at a time by iter_words
+BLOCK_SIZE = 1 << 20
+
+# Saved index files: magic, then the number of words, files, file word IDs
+# and unique word IDs, and the byte lengths of the word and key blobs
+INDEX_MAGIC = b"UWORDS02"
+INDEX_HEADER = struct.Struct("<8sqqqqqq")
+
+
 class UniqueWords:
     
     """ A class to track unique words across multiple text files
 
+    Each distinct word is stored once in a shared vocabulary and given an
+    integer ID. A file's words are kept as a sorted array of IDs, and each
+    word's document frequency (the number of files it appears in) as an
+    array indexed by ID, so the index costs a few bytes per word per file
+    rather than a set entry. The words found in only one file are kept per
+    file, so looking them up doesn't scan the file's words. Files can be
+    removed or replaced.
+
+    Every file added gets a number, and each word keeps the XOR of the
+    numbers of the files it appears in. When a word is left in only one
+    file, that XOR is the file's number, so removing a file only costs
+    time in proportion to its own words.
+
     Attributes:
-        all_words (set): A set containing all words encountered in the files read.
-        unique_words (set): A set containing words that appear in only one file.
-        words_by_file (dict): A dictionary mapping filenames (keys) to sets of words (values) that appear in each file. """
+        vocabulary (dict): A dictionary mapping each word to its ID.
+        words (list): The word for each ID.
+        doc_freq (array): The number of files each word ID appears in.
+        ids_by_file (dict): A dictionary mapping filenames (keys) to sorted arrays of the word IDs in each file.
+        owner (dict): A dictionary mapping the ID of each word that appears in only one file to that file's key.
+        unique_by_file (dict): A dictionary mapping each file key to the set of IDs of words that appear only in that file.
+        file_hashes (dict): A dictionary mapping each file key to the sha256 of the file's contents, if it was read from a file.
+        file_numbers (dict): A dictionary mapping each file key to its number.
+        keys_by_number (dict): A dictionary mapping each file number back to its key.
+        file_xor (array): The XOR of the numbers of the files each word ID appears in.
+        next_number (int): The number the next file added gets. """
 
     def __init__(self):
         
-        """ Initializing the UniqueWords class. Create two empty sets and one dictionary set """
+        """ Initializing the UniqueWords class. Create an empty vocabulary and index """
+        
+        self.vocabulary = {}
+        self.words = []
+        self.doc_freq = array('I')
+        self.ids_by_file = {}
+        self.owner = {}
+        self.unique_by_file = {}
+        self.file_hashes = {}
+        self.file_numbers = {}
+        self.keys_by_number = {}
+        self.file_xor = array('Q')
+        self.next_number = 1
+
+    @property
+    def all_words(self):
+        
+        """ A set of all words in the files currently added """
+        
+        return {self.words[i] for i, count in enumerate(self.doc_freq) if count}
+
+    @property
+    def unique_words(self):
+        
+        """ A set of the words that appear in only one file """
+        
+        return {self.words[i] for i in self.owner}
+
+    @property
+    def words_by_file(self):
+        
+        """ A dictionary mapping filenames (keys) to sets of words (values) that appear in each file """
+        
+        return {key: {self.words[i] for i in ids} for key, ids in self.ids_by_file.items()}
+
+    def word_ids(self, words_set):
+        
+        """ Look up the IDs of words, adding new words to the vocabulary
+
+        Args:
+            words_set (set): Distinct words
+
+        Returns:
+            array: The words' IDs, sorted """
         
-        self.all_words = set()
-        self.unique_words = set()
-        self.words_by_file = {}
+        ids = []
+        for word in words_set:
+            i = self.vocabulary.get(word)
+            if i is None:
+                i = self.vocabulary[word] = len(self.words)
+                self.words.append(word)
+                self.doc_freq.append(0)
+                self.file_xor.append(0)
+            ids.append(i)
+        ids.sort()
+        return array('I', ids)
 
     def add_file(self, filename, key):
         
         """ Adding a file with three parameters, self, filename, and key
 
+        If a file was already added with the same key, it is replaced,
+        unless its contents are unchanged, in which case nothing is done.
+
         Args:
             filename (string): The path for how the code is going to read the file
             key (string): The nickname for the file """
         
+        digest = hash_file(filename)
+        if key in self.ids_by_file and self.file_hashes.get(key) == digest:
+            return
+        
         with open(filename, 'r') as file:
-            reading = file.read()
+            words_set = set(iter_words(file))
+        
+        self.add_words(words_set, key, digest)
+
+    def add_files(self, mapping, processes=None):
+        
+        """ Add many files, tokenizing them in parallel
+
+        Files are read and tokenized by a pool of processes; each sends
+        back its file's distinct words, and they are merged into the index
+        here in the mapping's order, the same as calling add_file on each.
+        Files whose contents are unchanged since they were added under the
+        same key are hashed but not tokenized again.
+
+        Args:
+            mapping (dict): Nicknames (keys) mapped to the paths of the files to read
+            processes (int): Number of worker processes (default: one per CPU) """
+        
+        keys = list(mapping)
+        processes = processes or os.cpu_count() or 1
+        chunksize = max(1, len(keys) // (8 * processes))
+        known = [self.file_hashes.get(key) if key in self.ids_by_file else None for key in keys]
+        with ProcessPoolExecutor(processes) as pool:
+            results = pool.map(file_words, [mapping[key] for key in keys], known, chunksize=chunksize)
+            for key, (digest, packed) in zip(keys, results):
+                if packed is not None:
+                    self.add_words(set(packed.split("\n")) if packed else set(), key, digest)
+
+    def add_words(self, words_set, key, digest=None):
+        
+        """ Index a file's set of words under a key, replacing any file with the same key
+
+        Args:
+            words_set (set): The distinct words of the file
+            key (string): The nickname for the file
+            digest (string): The sha256 of the file, to skip it if it's added again unchanged (default: None) """
+        
+        if key in self.ids_by_file:
+            self.remove_file(key)
+        if digest is not None:
+            self.file_hashes[key] = digest
+        
+        ids = self.word_ids(words_set)
+        self.ids_by_file[key] = ids
+        number = self.next_number
+        self.next_number += 1
+        self.file_numbers[key] = number
+        self.keys_by_number[number] = key
+        doc_freq = self.doc_freq
+        file_xor = self.file_xor
+        unique_to_file = set()
+        for i in ids:
+            file_xor[i] ^= number
+            count = doc_freq[i]
+            if count == 0:
+                unique_to_file.add(i)
+                self.owner[i] = key
+            elif count == 1:
+                # the word was unique to another file, and isn't any more
+                self.unique_by_file[self.owner.pop(i)].discard(i)
+            doc_freq[i] = count + 1
+        self.unique_by_file[key] = unique_to_file
+
+    def remove_file(self, key):
+        
+        """ Remove a file, updating which words are unique
+
+        Args:
+            key (string): The nickname for the file
+
+        Raises:
+            ValueError: There is no file with that key """
         
-        words = get_words(reading)
-        words_set = set(words)
+        if key not in self.ids_by_file:
+            raise ValueError(f"There is no file with '{key}'")
         
-        self.words_by_file[key] = words_set
-        self.unique_words.difference_update(words_set)
-        new_unique_words = words_set.difference(self.all_words)
-        self.unique_words.update(new_unique_words)
-        self.all_words.update(words_set)
+        ids = self.ids_by_file.pop(key)
+        del self.unique_by_file[key]
+        self.file_hashes.pop(key, None)
+        number = self.file_numbers.pop(key)
+        del self.keys_by_number[number]
+        doc_freq = self.doc_freq
+        file_xor = self.file_xor
+        for i in ids:
+            count = doc_freq[i] - 1
+            doc_freq[i] = count
+            file_xor[i] ^= number
+            if count == 0:
+                del self.owner[i]
+            elif count == 1:
+                # with one file left, the XOR of the file numbers is that file's number
+                other = self.keys_by_number[file_xor[i]]
+                self.owner[i] = other
+                self.unique_by_file[other].add(i)
     
     def unique(self, key):
         
@@ -45,17 +228,126 @@ class UniqueWords:
         Result:
             set: The set of words from the specific file """
         
-        if key not in self.words_by_file:
+        if key not in self.ids_by_file:
             raise ValueError(f"There is no file with '{key}'")
         
-        file_words = self.words_by_file[key]
+        return {self.words[i] for i in self.unique_by_file[key]}
+
+    def save(self, filename):
         
-        unique_to_file = set()
-        for word in file_words:
-            if word in self.unique_words:
-                unique_to_file.add(word)
+        """ Write the whole index to a compact binary file
+
+        The vocabulary is one newline-separated blob, and the document
+        frequencies, file number XORs, file numbers and each file's word
+        IDs and unique word IDs are packed arrays, so load can map them
+        straight into memory.
+
+        Args:
+            filename (string): The path of the file to write
+
+        Raises:
+            ValueError: A file key isn't a string """
+        
+        keys = list(self.ids_by_file)
+        if not all(isinstance(key, str) for key in keys):
+            raise ValueError("only indexes whose file keys are strings can be saved")
+        vocabulary = "\n".join(self.words).encode('utf-8')
+        encoded_keys = [key.encode('utf-8') for key in keys]
+        key_offsets = array('q', [0])
+        id_offsets = array('q', [0])
+        unique_offsets = array('q', [0])
+        for key, encoded in zip(keys, encoded_keys):
+            key_offsets.append(key_offsets[-1] + len(encoded))
+            id_offsets.append(id_offsets[-1] + len(self.ids_by_file[key]))
+            unique_offsets.append(unique_offsets[-1] + len(self.unique_by_file[key]))
+        hashes = b"".join(bytes.fromhex(self.file_hashes.get(key, "00" * 32)) for key in keys)
+        
+        numbers = array('q', [self.file_numbers[key] for key in keys])
+        sections = [vocabulary, self.doc_freq, self.file_xor, b"".join(encoded_keys), key_offsets, hashes,
+                    numbers, id_offsets, unique_offsets]
+        sections.append(b"".join(bytes(self.ids_by_file[key]) for key in keys))
+        sections.append(b"".join(bytes(array('I', sorted(self.unique_by_file[key]))) for key in keys))
+        header = INDEX_HEADER.pack(INDEX_MAGIC, len(self.words), len(keys), id_offsets[-1],
+                                   unique_offsets[-1], len(vocabulary), key_offsets[-1])
+        
+        temp_file = f"{filename}.{os.getpid()}.tmp"
+        with open(temp_file, 'wb') as file:
+            file.write(header)
+            size = len(header)
+            for section in sections:
+                # each section starts 8-byte aligned
+                file.write(bytes(-size % 8))
+                size += -size % 8
+                file.write(section)
+                size += memoryview(section).nbytes
+        os.replace(temp_file, filename)
+
+    @classmethod
+    def load(cls, filename):
+        
+        """ Read an index written by save
+
+        The file is memory-mapped: each file's word IDs are used in place,
+        and only the vocabulary lookup and document frequencies are built
+        in memory.
+
+        Args:
+            filename (string): The path of the file to read
+
+        Returns:
+            UniqueWords: The index
+
+        Raises:
+            ValueError: The file isn't a saved index """
+        
+        with open(filename, 'rb') as file:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(buffer) < INDEX_HEADER.size or buffer[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+            raise ValueError(f"{filename} is not a saved UniqueWords index")
+        magic, n_words, n_files, n_ids, n_unique, vocabulary_bytes, key_bytes = INDEX_HEADER.unpack_from(buffer)
+        if min(n_words, n_files, n_ids, n_unique, vocabulary_bytes, key_bytes) < 0:
+            raise ValueError(f"{filename} is a damaged UniqueWords index")
+        
+        view = memoryview(buffer)
+        offset = INDEX_HEADER.size
+        sections = []
+        for typecode, length in [('B', vocabulary_bytes), ('I', n_words), ('Q', n_words), ('B', key_bytes),
+                                 ('q', n_files + 1), ('B', 32 * n_files), ('q', n_files), ('q', n_files + 1),
+                                 ('q', n_files + 1), ('I', n_ids), ('I', n_unique)]:
+            offset += -offset % 8
+            nbytes = length * struct.calcsize(typecode)
+            if offset + nbytes > len(buffer):
+                raise ValueError(f"{filename} is a damaged UniqueWords index")
+            sections.append(view[offset:offset + nbytes].cast(typecode))
+            offset += nbytes
+        if offset != len(buffer):
+            raise ValueError(f"{filename} is a damaged UniqueWords index")
+        (vocabulary, doc_freq, file_xor, keys, key_offsets, hashes, numbers,
+         id_offsets, unique_offsets, ids, unique_ids) = sections
+        for offsets, total in [(key_offsets, key_bytes), (id_offsets, n_ids), (unique_offsets, n_unique)]:
+            if offsets[0] != 0 or offsets[-1] != total or any(a > b for a, b in zip(offsets, offsets[1:])):
+                raise ValueError(f"{filename} is a damaged UniqueWords index")
         
-        return unique_to_file
+        index = cls()
+        index.buffer = buffer
+        index.words = bytes(vocabulary).decode('utf-8').split("\n") if n_words else []
+        index.vocabulary = dict(zip(index.words, range(n_words)))
+        index.doc_freq = array('I', doc_freq.tobytes())
+        index.file_xor = array('Q', file_xor.tobytes())
+        index.next_number = max(numbers, default=0) + 1
+        for n in range(n_files):
+            # the offsets count bytes, so each key is cut out before it is decoded
+            key = bytes(keys[key_offsets[n]:key_offsets[n + 1]]).decode('utf-8')
+            index.ids_by_file[key] = ids[id_offsets[n]:id_offsets[n + 1]]
+            index.file_numbers[key] = numbers[n]
+            index.keys_by_number[numbers[n]] = key
+            unique_to_file = set(unique_ids[unique_offsets[n]:unique_offsets[n + 1]])
+            index.unique_by_file[key] = unique_to_file
+            index.owner.update(dict.fromkeys(unique_to_file, key))
+            digest = bytes(hashes[32 * n:32 * n + 32])
+            if any(digest):
+                index.file_hashes[key] = digest.hex()
+        return index
 
 def get_words(s):
 
@@ -67,12 +359,72 @@ def get_words(s):
     Returns:
         list of str: a list of words from s converted to lower-case """
     
-    import re
     words = list()
-    s = re.sub(r"--+", " ", s)
-    for word in re.findall(r"[\w'-]+", s):
+    s = DASHES.sub(" ", s)
+    for word in WORD.findall(s):
         word = word.strip("'-_")
         if len(word) > 0:
             words.append(word.lower())
     return words
 
+def hash_file(filename):
+
+    """ The sha256 of a file's contents, as a hex string """
+
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as file:
+        for block in iter(lambda: file.read(BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def file_words(filename, known_digest=None):
+
+    """ Read a file's distinct words; run in a worker process by UniqueWords.add_files
+
+    Args:
+        filename (string): The path of the file to read
+        known_digest (string): The sha256 the file had when it was last added (default: None)
+
+    Returns:
+        tuple: the file's sha256, and its distinct words joined by
+        newlines (much cheaper to send between processes than a set of
+        strings), or None if the sha256 matches known_digest """
+
+    digest = hash_file(filename)
+    if digest == known_digest:
+        return digest, None
+    with open(filename, 'r') as file:
+        return digest, "\n".join(set(iter_words(file)))
+
+def iter_words(file, block_size=BLOCK_SIZE):
+
+    """ Yield the same words as get_words(file.read()), reading the file a block at a time
+
+    A run of word characters at the end of a block might continue in the
+    next block, so it is held back and joined to the next one. Only the
+    new block is searched for where that run starts, so a very long run
+    costs no more than reading it.
+
+    Args:
+        file (file): a file opened in text mode
+        block_size (int): characters to read at a time (default: BLOCK_SIZE)
+
+    Yields:
+        str: each word from the file converted to lower-case """
+
+    carry = []
+    while True:
+        block = file.read(block_size)
+        if not block:
+            break
+        # the last character that isn't part of a word, found from the end
+        separator = NON_WORD_CHAR.search(block[::-1])
+        if separator is None:
+            carry.append(block)
+            continue
+        cut = len(block) - separator.start()
+        carry.append(block[:cut])
+        yield from get_words("".join(carry))
+        carry = [block[cut:]]
+    yield from get_words("".join(carry))
+
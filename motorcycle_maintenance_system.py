@@ -1,14 +1,53 @@
+from argparse import ArgumentParser
 import datetime
 import pandas as pd
 import re
+import sqlite3
+import sys
+
+MAINTENANCE_COLUMNS = ['date', 'type', 'mileage']
+
+# How often each type of maintenance is due, by mileage and/or by days since it was last done
+MAINTENANCE_RULES = pd.DataFrame([
+    ("tire change", 10000, 1825, "Tire change"),
+    ("air filter", 7500, 1460, "Air filter replacement"),
+    ("clutch replacement", 25000, None, "Clutch replacement"),
+    ("chain replacement", 10000, None, "Chain replacement"),
+    ("valve adjustment", 20000, None, "Valve adjustment"),
+    ("brake pad", 20000, None, "Brake pad check/replacement"),
+    ("registration", None, 730, "Registration"),
+    ("oil change", 5000, 180, "Oil change"),
+], columns=['type', 'mileage_interval', 'day_interval', 'message'])
+
+# Records are only ever appended; the index on (vehicle, type, date) also
+# carries mileage so the latest-per-type check never reads the table itself
+RECORD_SCHEMA = ("""CREATE TABLE IF NOT EXISTS records
+                    (id INTEGER PRIMARY KEY, vehicle TEXT NOT NULL, date TEXT NOT NULL,
+                     type TEXT NOT NULL, mileage INTEGER NOT NULL)""",
+                 """CREATE INDEX IF NOT EXISTS records_by_type
+                    ON records (vehicle, type, date, mileage)""")
+RECORD_PRAGMAS = ("PRAGMA journal_mode = WAL", "PRAGMA synchronous = NORMAL")
+
+# Rows per page when viewing records, and per batch when exporting or importing Parquet
+VIEW_PAGE_ROWS = 50
+PARQUET_BATCH_ROWS = 100000
+
+# Rows read and validated at a time by import_records
+IMPORT_CHUNK_ROWS = 100000
+
+def main(db_path=None, import_file=None, reject_file=None):
+    if import_file is not None:
+        records = SQLiteStore(db_path)
+        records, imported, rejected = import_records(records, import_file, reject_file)
+        print(f"Imported {imported} records, rejected {rejected}" + (f" (see {reject_file})." if reject_file else "."))
+        return
 
-def main():
     print("Welcome to the Motorcycle Maintenance Record System")
 
     current_date = input_date("Enter the current date (YYYY-MM-DD): ")
     current_mileage = input("Enter the current mileage: ")
 
-    records = pd.DataFrame(columns=['date', 'type', 'mileage'])
+    records = RecordStore() if db_path is None else SQLiteStore(db_path)
     while True:
         action = input("Choose an action: 'add' to add a new record, 'view' to view records, 'check' to check maintenance requirements, or 'exit' to exit: ")
         if action.lower() == 'add':
@@ -17,7 +56,7 @@ def main():
             mileage = input("Enter the mileage at the time of maintenance: ")
             records = add_record(records, date, maintenance_type, mileage)
         elif action.lower() == 'view':
-            view_records(records)
+            view_records(records, more=lambda: input("Press Enter for more records, or 'q' to stop: ").lower() != 'q')
         elif action.lower() == 'check':
             check_maintenance(records, current_mileage, current_date)
         elif action.lower() == 'exit':
@@ -40,7 +79,256 @@ def parse_date(date_str):
     else:
         print("Invalid format. Please enter the date in the format YYYY-MM-DD.")
 
+class RecordStore:
+    """Maintenance records that are cheap to append to one at a time.
+
+    New records go into plain per-column lists, and are only turned into a
+    DataFrame (datetime64 dates, categorical types, int64 mileage) when
+    the frame is asked for, so adding a record never copies the history.
+    """
+
+    def __init__(self, records=None):
+        self.dates = []
+        self.types = []
+        self.mileages = []
+        # built on first use; an empty DataFrame is too costly to make for every vehicle in a fleet
+        self.frame = None
+        if records is not None:
+            self.frame = typed_records(records)
+
+    def __len__(self):
+        return (0 if self.frame is None else len(self.frame)) + len(self.mileages)
+
+    def append(self, date, maintenance_type, mileage):
+        self.dates.append(date)
+        self.types.append(maintenance_type)
+        self.mileages.append(int(mileage))
+
+    def extend(self, dates, maintenance_types, mileages):
+        dates, maintenance_types, mileages = list(dates), list(maintenance_types), [int(m) for m in mileages]
+        if not len(dates) == len(maintenance_types) == len(mileages):
+            raise ValueError("dates, types and mileages must be the same length")
+        self.dates.extend(dates)
+        self.types.extend(maintenance_types)
+        self.mileages.extend(mileages)
+
+    def to_frame(self):
+        """All records as a DataFrame, folding in anything appended since the last call."""
+        if self.frame is None:
+            self.frame = empty_records()
+        if self.mileages:
+            new_records = typed_records(pd.DataFrame({
+                'date': self.dates,
+                'type': self.types,
+                'mileage': self.mileages
+            }))
+            frames = [frame for frame in (self.frame, new_records) if not frame.empty]
+            self.frame = typed_records(pd.concat(frames, ignore_index=True))
+            self.dates, self.types, self.mileages = [], [], []
+        return self.frame
+
+
+class FleetStore:
+    """Maintenance records for many vehicles, keyed by vehicle ID.
+
+    Besides each vehicle's records and its current odometer and date, it
+    keeps the latest date and highest mileage of every (vehicle, type) up
+    to date as records are added, so a due report only has to look at
+    vehicles x types rather than regroup the whole history.
+    """
+
+    def __init__(self):
+        self.records = {}
+        self.odometer = {}
+        self.current_dates = {}
+        self.latest = {}
+
+    def vehicles(self):
+        return list(self.records.keys() | self.odometer.keys())
+
+    def update_vehicle(self, vehicle, current_date, current_mileage):
+        self.current_dates[vehicle] = current_date
+        self.odometer[vehicle] = max(self.odometer.get(vehicle, 0), int(current_mileage))
+
+    def add(self, vehicle, date, maintenance_type, mileage):
+        mileage = int(mileage)
+        if vehicle not in self.records:
+            self.records[vehicle] = RecordStore()
+        self.records[vehicle].append(date, maintenance_type, mileage)
+        # the odometer can't be lower than any mileage on record
+        self.odometer[vehicle] = max(self.odometer.get(vehicle, 0), mileage)
+        latest = self.latest.get((vehicle, maintenance_type))
+        if latest is None:
+            self.latest[vehicle, maintenance_type] = (date, mileage)
+        else:
+            self.latest[vehicle, maintenance_type] = (max(latest[0], date), max(latest[1], mileage))
+
+    def add_many(self, vehicles, dates, maintenance_types, mileages):
+        for vehicle, date, maintenance_type, mileage in zip(vehicles, dates, maintenance_types, mileages):
+            self.add(vehicle, date, maintenance_type, mileage)
+
+    def latest_records(self, current_date=None):
+        """One row per (vehicle, type) with the mileage and days since it was last done.
+
+        Vehicles without a current date of their own are measured from
+        current_date, or today if that isn't given either.
+        """
+        if current_date is None:
+            current_date = datetime.datetime.now()
+        keys = list(self.latest)
+        values = list(self.latest.values())
+        vehicles = [vehicle for vehicle, maintenance_type in keys]
+        latest = pd.DataFrame({
+            'vehicle': vehicles,
+            'type': [maintenance_type for vehicle, maintenance_type in keys],
+            'date': pd.to_datetime([date for date, mileage in values]),
+            'mileage': pd.array([mileage for date, mileage in values], dtype='int64')
+        })
+        odometer = pd.Series([self.odometer[vehicle] for vehicle in vehicles], dtype='int64')
+        current_dates = pd.to_datetime([self.current_dates.get(vehicle, current_date) for vehicle in vehicles])
+        latest['mileage'] = odometer - latest['mileage']
+        latest['date'] = (current_dates - pd.DatetimeIndex(latest['date'])).days
+        return latest
+
+    def due_report(self, current_date=None, rules=MAINTENANCE_RULES):
+        """Everything due across the fleet; see due_maintenance."""
+        return due_maintenance(self.latest_records(current_date), rules, vehicles=self.vehicles())
+
+
+class SQLiteStore:
+    """Maintenance records kept in an append-only sqlite database.
+
+    Records are never loaded all at once: they are read back a page at a
+    time, and the maintenance check asks sqlite for the latest record of
+    each type. One database can hold several vehicles' records; a store
+    reads and writes only its own vehicle's.
+    """
+
+    def __init__(self, db_path, vehicle=''):
+        self.db_path = db_path
+        self.vehicle = vehicle
+        self.conn = sqlite3.connect(db_path)
+        for pragma in RECORD_PRAGMAS:
+            self.conn.execute(pragma)
+        with self.conn:
+            for statement in RECORD_SCHEMA:
+                self.conn.execute(statement)
+
+    def __del__(self):
+        try:
+            self.conn.close()
+        except:
+            pass
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM records WHERE vehicle = ?", (self.vehicle,)).fetchone()[0]
+
+    def __repr__(self):
+        return f"{len(self)} records for vehicle {self.vehicle!r} in {self.db_path}"
+
+    def append(self, date, maintenance_type, mileage):
+        self.extend([date], [maintenance_type], [mileage])
+
+    def extend(self, dates, maintenance_types, mileages):
+        dates = pd.to_datetime(pd.Series(dates)).dt.strftime('%Y-%m-%d')
+        rows = ((self.vehicle, date, maintenance_type, int(mileage))
+                for date, maintenance_type, mileage in zip(dates, maintenance_types, mileages))
+        with self.conn:
+            self.conn.executemany("INSERT INTO records (vehicle, date, type, mileage) VALUES (?, ?, ?, ?)", rows)
+
+    def pages(self, page_rows=VIEW_PAGE_ROWS):
+        """Yield the records in the order they were added, as DataFrames of up to page_rows rows."""
+        last_id = 0
+        start = 0
+        while True:
+            rows = self.conn.execute("""SELECT id, date, type, mileage FROM records
+                                        WHERE vehicle = ? AND id > ? ORDER BY id LIMIT ?""",
+                                     (self.vehicle, last_id, page_rows)).fetchall()
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            page = typed_records(pd.DataFrame([row[1:] for row in rows], columns=MAINTENANCE_COLUMNS))
+            page.index = pd.RangeIndex(start, start + len(page))
+            start += len(page)
+            yield page
+
+    def to_frame(self):
+        frames = list(self.pages(PARQUET_BATCH_ROWS))
+        if not frames:
+            return empty_records()
+        return typed_records(pd.concat(frames))
+
+    def max_mileage(self):
+        return self.conn.execute("SELECT MAX(mileage) FROM records WHERE vehicle = ?", (self.vehicle,)).fetchone()[0]
+
+    def latest_by_type(self):
+        """The latest date and highest mileage of each type, like grouping the records by type and taking the max."""
+        rows = self.conn.execute("""SELECT type, MAX(date), MAX(mileage) FROM records
+                                    WHERE vehicle = ? GROUP BY type ORDER BY type""", (self.vehicle,)).fetchall()
+        return pd.DataFrame(rows, columns=['type', 'date', 'mileage']).astype({
+            'date': 'datetime64[ns]',
+            'mileage': 'int64'
+        })
+
+    def export_parquet(self, filename):
+        """Write this vehicle's records to a Parquet file, a batch at a time."""
+        pa = import_pyarrow()
+        writer = None
+        try:
+            for page in self.pages(PARQUET_BATCH_ROWS):
+                table = pa.Table.from_pandas(page.astype({'type': str}), preserve_index=False)
+                if writer is None:
+                    writer = pa.parquet.ParquetWriter(filename, table.schema)
+                writer.write_table(table)
+            if writer is None:
+                pa.parquet.write_table(pa.Table.from_pandas(empty_records().astype({'type': str}), preserve_index=False), filename)
+        finally:
+            if writer is not None:
+                writer.close()
+
+    def import_parquet(self, filename):
+        """Append the records in a Parquet file written by export_parquet."""
+        pa = import_pyarrow()
+        parquet = pa.parquet.ParquetFile(filename)
+        for batch in parquet.iter_batches(batch_size=PARQUET_BATCH_ROWS, columns=MAINTENANCE_COLUMNS):
+            page = batch.to_pandas()
+            self.extend(pd.to_datetime(page['date']), page['type'], page['mileage'])
+
+
+def import_pyarrow():
+    """Import pyarrow, which is only needed for Parquet files; raises ValueError if it isn't installed."""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ValueError("reading or writing Parquet files requires pyarrow") from None
+    return pyarrow
+
+
+def empty_records():
+    return typed_records(pd.DataFrame(columns=MAINTENANCE_COLUMNS))
+
+
+def typed_records(records):
+    return records[MAINTENANCE_COLUMNS].astype({
+        'date': 'datetime64[ns]',
+        'type': 'category',
+        'mileage': 'int64'
+    })
+
+
+def as_frame(records):
+    if isinstance(records, RecordStore):
+        return records.to_frame()
+    return records
+
+
 def add_record(records, date, maintenance_type, mileage):
+    if isinstance(records, (RecordStore, SQLiteStore)):
+        records.append(date, maintenance_type, mileage)
+        print("Record added successfully.")
+        return records
+
     new_record = pd.DataFrame({
         'date': [date],
         'type': [maintenance_type],
@@ -60,7 +348,106 @@ def add_record(records, date, maintenance_type, mileage):
     return records
 
 
-def view_records(records):
+def add_records(records, dates, maintenance_types, mileages):
+    """Add many records at once, e.g. for an import; returns the records like add_record."""
+    if not isinstance(records, (RecordStore, SQLiteStore)):
+        records = RecordStore(records)
+    records.extend(dates, maintenance_types, mileages)
+    return records
+
+
+def read_record_chunks(filename, chunk_rows=IMPORT_CHUNK_ROWS):
+    """Read a CSV or JSON Lines service log a chunk at a time, as strings where possible.
+
+    Files ending in .jsonl or .json are read as JSON Lines, anything else
+    as CSV. Each chunk is indexed by row number in the file, from 1.
+    """
+    if filename.endswith(('.jsonl', '.json')):
+        chunks = pd.read_json(filename, lines=True, chunksize=chunk_rows, dtype=False, convert_dates=False)
+    else:
+        chunks = pd.read_csv(filename, chunksize=chunk_rows, dtype=str, keep_default_na=False)
+    start = 1
+    for chunk in chunks:
+        chunk.index = pd.RangeIndex(start, start + len(chunk), name='row')
+        start += len(chunk)
+        yield chunk
+
+
+def validate_records(chunk, columns=MAINTENANCE_COLUMNS):
+    """Check a chunk of imported rows all at once.
+
+    Returns the valid rows as typed records, and the invalid rows as they
+    were read, with a 'reason' column saying what was wrong with each.
+    """
+    missing = [column for column in columns if column not in chunk.columns]
+    if missing:
+        raise ValueError(f"missing column(s): {', '.join(missing)}")
+
+    dates = pd.to_datetime(chunk['date'], format='%Y-%m-%d', errors='coerce')
+    types = chunk['type'].where(chunk['type'].notna(), '').astype(str).str.strip()
+    mileages = pd.to_numeric(chunk['mileage'], errors='coerce')
+    # NaN fails every comparison, so unreadable mileages are rejected too
+    bad_mileage = ~((mileages % 1 == 0) & (mileages >= 0) & (mileages < 2 ** 63))
+
+    # checked in reverse order, so each row gets the first reason that applies
+    reason = pd.Series("", index=chunk.index).mask(bad_mileage, "invalid mileage").mask(types.eq(""), "missing type")
+    if 'vehicle' in columns:
+        vehicles = chunk['vehicle'].where(chunk['vehicle'].notna(), '').astype(str).str.strip()
+        reason = reason.mask(vehicles.eq(""), "missing vehicle")
+    reason = reason.mask(dates.isna(), "invalid date")
+    bad = reason.ne("")
+
+    good = pd.DataFrame({'date': dates[~bad], 'type': types[~bad], 'mileage': mileages[~bad].astype('int64')})
+    if 'vehicle' in columns:
+        good.insert(0, 'vehicle', vehicles[~bad])
+    return good, chunk[bad].assign(reason=reason[bad])
+
+
+def import_records(records, filename, reject_file=None, chunk_rows=IMPORT_CHUNK_ROWS):
+    """Add every valid row of a CSV or JSON Lines service log to the records.
+
+    The file needs date (YYYY-MM-DD), type and mileage columns, plus
+    vehicle when importing into a FleetStore. Invalid rows don't stop the
+    import: they are written to reject_file (if given) as CSV, with their
+    row number and the reason they were rejected.
+
+    Returns:
+        tuple: the records (as from add_records), the number of rows imported and the number rejected
+    """
+    columns = ['vehicle'] + MAINTENANCE_COLUMNS if isinstance(records, FleetStore) else MAINTENANCE_COLUMNS
+    imported = rejected = 0
+    report = None if reject_file is None else open(reject_file, 'w', newline='', encoding='utf-8')
+    try:
+        for chunk in read_record_chunks(filename, chunk_rows):
+            good, bad = validate_records(chunk, columns)
+            if isinstance(records, FleetStore):
+                records.add_many(good['vehicle'], good['date'], good['type'], good['mileage'])
+            else:
+                records = add_records(records, good['date'], good['type'], good['mileage'])
+            if report is not None:
+                bad.to_csv(report, header=report.tell() == 0)
+            imported += len(good)
+            rejected += len(bad)
+    finally:
+        if report is not None:
+            report.close()
+    return records, imported, rejected
+
+
+def view_records(records, page_rows=VIEW_PAGE_ROWS, more=None):
+    """Print the records; records in a database are printed a page at a time, calling more() between pages to see whether to go on."""
+    if isinstance(records, SQLiteStore):
+        shown = False
+        for page in records.pages(page_rows):
+            if shown and more is not None and not more():
+                return
+            print(page.to_string(header=not shown))
+            shown = True
+        if not shown:
+            print("No records available.")
+        return
+
+    records = as_frame(records)
     if records.empty:
         print("No records available.")
         return
@@ -68,58 +455,33 @@ def view_records(records):
 
 def check_maintenance(records, current_mileage, current_date):
     
-    if records.empty:
-        print("No records available to check.")
-        return
+    if isinstance(records, SQLiteStore):
+        if len(records) == 0:
+            print("No records available to check.")
+            return
+        latest_mileage = max(records.max_mileage(), int(current_mileage))
+        latest_record = records.latest_by_type()
+    else:
+        records = as_frame(records)
+        if records.empty:
+            print("No records available to check.")
+            return
     
-    # latest data
-    latest_mileage = max(records['mileage'].max(), int(current_mileage))
+        # latest data
+        latest_mileage = max(records['mileage'].max(), int(current_mileage))
 
-    # last mileage and date record chenum
-    latest_record = records.groupby("type")[["date", "mileage"]].max().reset_index()
+        # last mileage and date record chenum
+        latest_record = records.groupby("type", observed=True)[["date", "mileage"]].max().reset_index()
 
     # get delta mileage
     latest_record["mileage"] = latest_mileage - latest_record["mileage"]
     latest_record["date"] = (current_date - pd.to_datetime(latest_record["date"])).dt.days
+    due = due_maintenance(latest_record)
     latest_record.set_index("type", inplace=True)
 
-    # check mileage
-    do_maintenance = False
-    if ("tire change" not in latest_record.index) or latest_record.loc["tire change", "mileage"] >= 10000:
-        print("Tire change is due.")
-        do_maintenance = True
-    if ("air filter" not in latest_record.index) or latest_record.loc["air filter", "mileage"] >= 7500:
-        print("Air filter replacement is due.")
-        do_maintenance = True
-    if ("clutch replacement" not in latest_record.index) or latest_record.loc["clutch replacement", "mileage"] >= 25000:
-        print("Clutch replacement is due.")
-        do_maintenance = True
-    if ("chain replacement" not in latest_record.index) or latest_record.loc["chain replacement", "mileage"] >= 10000:
-        print("Chain replacement is due.")
-        do_maintenance = True
-    if ("valve adjustment" not in latest_record.index) or latest_record.loc["valve adjustment", "mileage"] >= 20000:
-        print("Valve adjustment is due.")
-        do_maintenance = True
-    if ("brake pad" not in latest_record.index) or latest_record.loc["brake pad", "mileage"] >= 20000:
-        print("Brake pad check/replacement is due.")
-        do_maintenance = True
-    if ("oil change" not in latest_record.index) or latest_record.loc["oil change", "mileage"] >= 5000:
-        print("Oil change is due.")
-        do_maintenance = True
-
-    # check timings
-    if ("tire change" not in latest_record.index) or latest_record.loc["tire change", "date"] >= 1825:
-        print("Tire change is due, due to time.")
-        do_maintenance = True
-    if ("air filter" not in latest_record.index) or latest_record.loc["air filter", "date"] >= 1460:
-        print("Air filter replacement is due, due to time.")
-        do_maintenance = True
-    if ("registration" not in latest_record.index) or latest_record.loc["registration", "date"] >= 730:
-        print("Registration is due, due to time.")
-        do_maintenance = True
-    if ("oil change" not in latest_record.index) or latest_record.loc["oil change", "date"] >= 180:
-        print("Oil change is due, due to time.")
-        do_maintenance = True
+    for message in due["message"]:
+        print(message)
+    do_maintenance = not due.empty
 
     print(latest_record)
     print(latest_mileage)
@@ -130,5 +492,57 @@ def check_maintenance(records, current_mileage, current_date):
         print("No maintenance due! Eat some ice cream...")
 
 
+def due_maintenance(latest, rules=MAINTENANCE_RULES, vehicles=None):
+    """Check every rule against the latest record of each type, all at once.
+
+    latest has one row per type (and per vehicle, if it has a 'vehicle'
+    column) with the mileage and days since that type was last done. A
+    type that was never done is always due. The result has a row per
+    due item: mileage checks first, then time checks, each in rule order.
+    vehicles lists vehicles to check that may have no records at all.
+    """
+    latest = latest[[column for column in ['vehicle', 'type', 'mileage', 'date'] if column in latest.columns]]
+    latest = latest.astype({'type': object})
+    single = 'vehicle' not in latest.columns
+    if single:
+        latest = latest.assign(vehicle=0)
+    if vehicles is None:
+        vehicles = [0] if single else latest['vehicle'].unique()
+
+    rules = rules.reset_index(drop=True).rename_axis('rule').reset_index()
+    checks = (pd.DataFrame({'vehicle': vehicles})
+              .merge(rules, how='cross')
+              .merge(latest, on=['vehicle', 'type'], how='left'))
+
+    # a missing latest record compares as NaN, which is never under the interval
+    mileage_due = checks['mileage_interval'].notna() & ~(checks['mileage'] < checks['mileage_interval'])
+    time_due = checks['day_interval'].notna() & ~(checks['date'] < checks['day_interval'])
+    due = pd.concat([
+        checks[mileage_due].assign(reason='mileage', message=lambda due: due['message'] + " is due."),
+        checks[time_due].assign(reason='time', message=lambda due: due['message'] + " is due, due to time."),
+    ])
+    due = due.sort_values(['vehicle', 'reason', 'rule'], kind='stable')
+    due = due[['vehicle', 'type', 'reason', 'message']].reset_index(drop=True)
+    if single:
+        due = due.drop(columns='vehicle')
+    return due
+
+
+def parse_args(arglist):
+    """Parse command-line arguments."""
+    parser = ArgumentParser()
+    parser.add_argument("--db", help="sqlite database file to keep the records in between runs")
+    parser.add_argument("--import", dest="import_file",
+                        help="CSV or JSON Lines service log to add to the --db records, then exit")
+    parser.add_argument("--rejects", help="where --import reports invalid rows (default: the log's name + '.rejects.csv')")
+    args = parser.parse_args(arglist)
+    # imported records would be thrown away on exit without a database to keep them in
+    if args.import_file and args.db is None:
+        parser.error("--import requires --db")
+    return args
+
+
 if __name__ == "__main__":
-    main()
+    args = parse_args(sys.argv[1:])
+    main(args.db, args.import_file,
+         args.rejects or (args.import_file + ".rejects.csv" if args.import_file else None))